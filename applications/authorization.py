@@ -0,0 +1,79 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, jsonify, g
+from flask_jwt_extended import verify_jwt_in_request, get_jwt
+from configuration import application
+from revocation import revocation_list
+
+
+class ClaimsCache:
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is None:
+                return None
+
+            if claims.get('exp') is not None and claims['exp'] <= time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, key, claims):
+        with self._lock:
+            self._entries[key] = claims
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+claims_cache = ClaimsCache(application.config['JWT_CLAIMS_CACHE_SIZE'])
+
+
+def verified_claims():
+    header = request.headers.get('Authorization')
+    key = hashlib.sha256(header.encode('utf-8')).digest() if header else None
+
+    claims = claims_cache.get(key) if key else None
+    if claims is None:
+        # Cache miss: let flask_jwt_extended decode, verify and report errors as usual.
+        verify_jwt_in_request()
+        claims = get_jwt()
+        if key:
+            claims_cache.put(key, claims)
+
+    return claims
+
+
+def roles_required(role):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            claims = verified_claims()
+            if revocation_list.is_revoked(claims):
+                return jsonify({"msg": "Token has been revoked"}), 401
+
+            if role not in claims.get('roles', []):
+                return jsonify({"msg": "Missing Authorization Header"}), 401
+
+            g.jwt_claims = claims
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current_claims():
+    return g.jwt_claims
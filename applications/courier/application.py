@@ -7,9 +7,11 @@ blockchain_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'block
 sys.path.insert(0, blockchain_path)
 
 from flask import request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt
 from configuration import application, database
-from models import Order, CourierAssignment
+from pool_metrics import pool_statistics
+from authorization import roles_required
+from models import Order, CourierAssignment, create_tables, create_statistics_indexes
+from statistics_cache import bump_orders_version, create_cache_versions
 from web3 import Web3
 
 GANACHE_URL = os.environ.get('GANACHE_URL', 'http://ganache:8545')
@@ -21,12 +23,8 @@ from utils import check_is_paid, assign_courier_tx
 
 
 @application.route('/orders_to_deliver', methods=['GET'])
-@jwt_required()
+@roles_required('courier')
 def orders_to_deliver():
-    jwt_data = get_jwt()
-    if 'courier' not in jwt_data.get('roles', []):
-        return jsonify({"msg": "Missing Authorization Header"}), 401
-
     orders = Order.query.filter_by(status='CREATED').all()
 
     orders_list = []
@@ -40,12 +38,8 @@ def orders_to_deliver():
 
 
 @application.route('/pick_up_order', methods=['POST'])
-@jwt_required()
+@roles_required('courier')
 def pick_up_order():
-    user_roles = get_jwt().get('roles', [])
-    if 'courier' not in user_roles:
-        return jsonify({"msg": "Missing Authorization Header"}), 401
-
     req_data = request.get_json()
 
     if 'id' not in req_data:
@@ -94,13 +88,27 @@ def pick_up_order():
                 return jsonify({"message": str(error)}), 400
 
     order.status = 'PENDING'
+    bump_orders_version()
     database.session.commit()
 
     return '', 200
 
 
+@application.route('/metrics', methods=['GET'])
+@roles_required('owner')
+def metrics():
+    return jsonify({"database_pool": pool_statistics(database.engines)}), 200
+
+
+@application.cli.command('init-db')
+def init_db_command():
+    create_tables()
+    create_statistics_indexes()
+    create_cache_versions()
+
+
 if __name__ == '__main__':
     with application.app_context():
-        database.create_all()
+        create_tables()
 
     application.run(host='0.0.0.0', port=5000, debug=True)
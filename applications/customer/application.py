@@ -7,10 +7,13 @@ blockchain_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'block
 sys.path.insert(0, blockchain_path)
 
 from flask import request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt
 from datetime import datetime
 from configuration import application, database
-from models import Product, Category, ProductCategory, Order, OrderItem
+from pool_metrics import pool_statistics
+from authorization import roles_required, current_claims
+from models import Product, Category, ProductCategory, Order, OrderItem, create_tables, create_statistics_indexes
+from sales import record_order, record_delivery, record_sales_events
+from statistics_cache import bump_orders_version, create_cache_versions
 from web3 import Web3
 import json
 
@@ -23,12 +26,8 @@ from deploy import deploy_payment_contract
 from utils import check_is_paid, build_pay_transaction, confirm_delivery_tx
 
 @application.route('/search', methods=['GET'])
-@jwt_required()
+@roles_required('customer')
 def search():
-    jwt_data = get_jwt()
-    if 'customer' not in jwt_data.get('roles', []):
-        return jsonify({"msg": "Missing Authorization Header"}), 401
-
     product_name = request.args.get('name', '')
     category_name = request.args.get('category', '')
 
@@ -82,11 +81,9 @@ def search():
 
 
 @application.route('/order', methods=['POST'])
-@jwt_required()
+@roles_required('customer')
 def order():
-    user_data = get_jwt()
-    if 'customer' not in user_data.get('roles', []):
-        return jsonify({"msg": "Missing Authorization Header"}), 401
+    user_data = current_claims()
 
     customer_email = user_data['sub']
 
@@ -151,11 +148,13 @@ def order():
                 'price': product.price
             })
 
+        # Whole seconds: MySQL DATETIME would round the microseconds, possibly into the next hour,
+        # and the rollup bucket written here must match the one record_delivery() reads back.
         new_order = Order(
             customer_email=customer_email,
             price=total_price,
             status='CREATED',
-            timestamp=datetime.utcnow()
+            timestamp=datetime.utcnow().replace(microsecond=0)
         )
 
         if customer_address and OWNER_PRIVATE_KEY:
@@ -183,6 +182,10 @@ def order():
             )
             database.session.add(order_item)
 
+        changes = record_order(new_order.timestamp, [
+            (item_data['product_id'], item_data['quantity'], item_data['price']) for item_data in order_items_data
+        ])
+        record_sales_events(bump_orders_version(), changes)
         database.session.commit()
 
         return jsonify({"id": new_order.id}), 200
@@ -194,13 +197,9 @@ def order():
 
 @application.route('/pay', methods=['POST'])
 @application.route('/generate_invoice', methods=['POST'])
-@jwt_required()
+@roles_required('customer')
 def pay():
-    user_roles = get_jwt().get('roles', [])
-    if 'customer' not in user_roles:
-        return jsonify({"msg": "Missing Authorization Header"}), 401
-
-    customer_email = get_jwt()['sub']
+    customer_email = current_claims()['sub']
 
     json_data = request.get_json()
 
@@ -248,11 +247,9 @@ def pay():
 
 
 @application.route('/status', methods=['GET'])
-@jwt_required()
+@roles_required('customer')
 def status():
-    jwt_data = get_jwt()
-    if 'customer' not in jwt_data.get('roles', []):
-        return jsonify({"msg": "Missing Authorization Header"}), 401
+    jwt_data = current_claims()
 
     customer_email = jwt_data['sub']
 
@@ -295,11 +292,9 @@ def status():
 
 
 @application.route('/delivered', methods=['POST'])
-@jwt_required()
+@roles_required('customer')
 def delivered():
-    user_data = get_jwt()
-    if 'customer' not in user_data.get('roles', []):
-        return jsonify({"msg": "Missing Authorization Header"}), 401
+    user_data = current_claims()
 
     customer_email = user_data['sub']
 
@@ -329,7 +324,15 @@ def delivered():
     if order.status != 'PENDING':
         return jsonify({"message": "Invalid order id."}), 400
 
-    order.status = 'COMPLETE'
+    # Conditional, so that of two concurrent calls only one completes the order and moves its counters;
+    # the row stays locked until this transaction ends.
+    completed = Order.query.filter(Order.id == order.id, Order.status == 'PENDING').update(
+        {'status': 'COMPLETE'},
+        synchronize_session=False
+    )
+    if completed != 1:
+        database.session.rollback()
+        return jsonify({"message": "Invalid order id."}), 400
 
     if order.contract_address and OWNER_PRIVATE_KEY:
         try:
@@ -338,13 +341,28 @@ def delivered():
             database.session.rollback()
             return jsonify({"message": str(error)}), 400
 
+    changes = record_delivery(order.id)
+    record_sales_events(bump_orders_version(), changes)
     database.session.commit()
 
     return '', 200
 
 
+@application.route('/metrics', methods=['GET'])
+@roles_required('owner')
+def metrics():
+    return jsonify({"database_pool": pool_statistics(database.engines)}), 200
+
+
+@application.cli.command('init-db')
+def init_db_command():
+    create_tables()
+    create_statistics_indexes()
+    create_cache_versions()
+
+
 if __name__ == '__main__':
     with application.app_context():
-        database.create_all()
+        create_tables()
 
     application.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,37 @@
+import os
+
+bind = '0.0.0.0:5000'
+
+workers = int(os.environ.get('GUNICORN_WORKERS', (os.cpu_count() or 1) * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 25))
+
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+
+    from configuration import application, database
+
+    # Connections opened by the master while preloading must not be shared with the workers.
+    with application.app_context():
+        for engine in database.engines.values():
+            engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # Runs in each worker once the application is loaded; services with background threads
+    # (the owner's import worker and sales feed) start them here.
+    import application
+
+    start_background_workers = getattr(application, 'start_background_workers', None)
+    if start_background_workers is not None:
+        start_background_workers()
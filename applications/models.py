@@ -1,4 +1,4 @@
-from configuration import database
+from configuration import application, database
 
 class ProductCategory(database.Model):
     __tablename__ = 'product_categories'
@@ -28,6 +28,44 @@ class Product(database.Model):
         return '<Product {} (${})>'.format(self.name, self.price)
 
 
+class ProductHash(database.Model):
+    __tablename__ = 'product_hashes'
+
+    product_id = database.Column(database.Integer, database.ForeignKey('products.id'), primary_key=True)
+    hash = database.Column(database.String(64), nullable=False)
+
+    def __repr__(self):
+        return '<ProductHash product_id={} {}>'.format(self.product_id, self.hash)
+
+
+class ProductSalesCounter(database.Model):
+    __tablename__ = 'product_sales_counters'
+
+    product_id = database.Column(database.Integer, database.ForeignKey('products.id'), primary_key=True)
+    sold = database.Column(database.Integer, nullable=False, default=0)
+    waiting = database.Column(database.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<ProductSalesCounter product_id={} sold={} waiting={}>'.format(self.product_id, self.sold, self.waiting)
+
+
+class ProductSalesRollup(database.Model):
+    __tablename__ = 'product_sales_rollups'
+
+    granularity = database.Column(database.String(8), primary_key=True)
+    bucket = database.Column(database.DateTime, primary_key=True)
+    product_id = database.Column(database.Integer, database.ForeignKey('products.id'), primary_key=True)
+    sold = database.Column(database.Integer, nullable=False, default=0)
+    waiting = database.Column(database.Integer, nullable=False, default=0)
+    sold_revenue = database.Column(database.Float(53), nullable=False, default=0)
+    waiting_revenue = database.Column(database.Float(53), nullable=False, default=0)
+
+    def __repr__(self):
+        return '<ProductSalesRollup {} {} product_id={} sold={} waiting={}>'.format(
+            self.granularity, self.bucket, self.product_id, self.sold, self.waiting
+        )
+
+
 class Category(database.Model):
     __tablename__ = 'categories'
 
@@ -46,6 +84,9 @@ class Category(database.Model):
 
 class Order(database.Model):
     __tablename__ = 'orders'
+    __table_args__ = (
+        database.Index('ix_orders_status_id', 'status', 'id'),
+    )
 
     id = database.Column(database.Integer, primary_key=True)
     customer_email = database.Column(database.String(256), nullable=False)
@@ -65,6 +106,9 @@ class Order(database.Model):
 
 class OrderItem(database.Model):
     __tablename__ = 'order_items'
+    __table_args__ = (
+        database.Index('ix_order_items_product_order', 'product_id', 'order_id'),
+    )
 
     id = database.Column(database.Integer, primary_key=True)
     order_id = database.Column(database.Integer, database.ForeignKey('orders.id'), nullable=False)
@@ -79,6 +123,26 @@ class OrderItem(database.Model):
         return '<OrderItem order={} product={} qty={}>'.format(self.order_id, self.product_id, self.quantity)
 
 
+STATISTICS_INDEXES = [
+    index for model in (Order, OrderItem) for index in model.__table__.indexes
+]
+
+
+def create_tables():
+    database.create_all(bind_key=None)
+
+    # A separate revocation database is read through a SELECT-only account and gets its table from
+    # its own init script; without REVOCATION_DATABASE_URL the log lives in the store database.
+    if application.config['SQLALCHEMY_BINDS']['revocations']['url'] == application.config['SQLALCHEMY_DATABASE_URI']:
+        database.create_all(bind_key='revocations')
+
+
+def create_statistics_indexes():
+    # create_all() skips tables that already exist, so indexes added later are created here.
+    for index in STATISTICS_INDEXES:
+        index.create(database.engine, checkfirst=True)
+
+
 class CourierAssignment(database.Model):
     __tablename__ = 'courier_assignments'
 
@@ -90,3 +154,76 @@ class CourierAssignment(database.Model):
 
     def __repr__(self):
         return '<CourierAssignment order={} courier={}>'.format(self.order_id, self.courier_address)
+
+
+class TokenRevocation(database.Model):
+    __bind_key__ = 'revocations'
+    __tablename__ = 'token_revocations'
+
+    id = database.Column(database.Integer, primary_key=True)
+    subject = database.Column(database.String(256), nullable=False, index=True)
+    revoked_at = database.Column(database.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<TokenRevocation {} at {}>'.format(self.subject, self.revoked_at)
+
+
+class ImportJob(database.Model):
+    __tablename__ = 'import_jobs'
+
+    id = database.Column(database.Integer, primary_key=True)
+    status = database.Column(database.String(64), nullable=False, default='QUEUED')
+    mode = database.Column(database.String(16), nullable=False, default='insert')
+    file_path = database.Column(database.String(1024), nullable=False)
+    rows_parsed = database.Column(database.Integer, nullable=False, default=0)
+    rows_written = database.Column(database.Integer, nullable=False, default=0)
+    lines_committed = database.Column(database.Integer, nullable=False, default=0)
+    rows_inserted = database.Column(database.Integer, nullable=False, default=0)
+    rows_updated = database.Column(database.Integer, nullable=False, default=0)
+    rows_unchanged = database.Column(database.Integer, nullable=False, default=0)
+    error = database.Column(database.Text, nullable=True)
+    created_at = database.Column(database.DateTime, nullable=False)
+    started_at = database.Column(database.DateTime, nullable=True)
+    finished_at = database.Column(database.DateTime, nullable=True)
+    heartbeat_at = database.Column(database.DateTime, nullable=True)
+    claim_token = database.Column(database.String(32), nullable=True)
+
+    def __repr__(self):
+        return '<ImportJob %d [%s] %d/%d>' % (self.id, self.status, self.rows_written, self.rows_parsed)
+
+
+class CacheVersion(database.Model):
+    __tablename__ = 'cache_versions'
+
+    name = database.Column(database.String(64), primary_key=True)
+    version = database.Column(database.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<CacheVersion {} {}>'.format(self.name, self.version)
+
+
+class StatisticsCacheEntry(database.Model):
+    __tablename__ = 'statistics_cache'
+
+    key = database.Column(database.String(64), primary_key=True)
+    version = database.Column(database.BigInteger, nullable=False)
+    body = database.Column(database.Text(2 ** 32 - 1), nullable=False)
+
+    def __repr__(self):
+        return '<StatisticsCacheEntry {} v{}>'.format(self.key, self.version)
+
+
+class SalesEvent(database.Model):
+    __tablename__ = 'sales_events'
+
+    id = database.Column(database.Integer, primary_key=True)
+    version = database.Column(database.BigInteger, nullable=False, index=True)
+    product_id = database.Column(database.Integer, database.ForeignKey('products.id'), nullable=False)
+    sold = database.Column(database.Integer, nullable=False, default=0)
+    waiting = database.Column(database.Integer, nullable=False, default=0)
+    created_at = database.Column(database.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<SalesEvent v{} product_id={} sold={:+d} waiting={:+d}>'.format(
+            self.version, self.product_id, self.sold, self.waiting
+        )
@@ -3,162 +3,517 @@ import os
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import base64
+import binascii
+import json
+import click
+from datetime import datetime, timezone
 from flask import request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt
 from configuration import application, database
-from models import Product, Category, ProductCategory, Order, OrderItem
-import io
-import csv
+from pool_metrics import pool_statistics
+from authorization import roles_required
+from models import Product, Category, ProductCategory, OrderItem, ProductSalesCounter, ProductSalesRollup, ImportJob, create_tables, create_statistics_indexes
+from sales import rebuild_counters, verify_counters, verify_rollups, rollup_window, bucket_range, bucket_start, advance_events_horizon, GRANULARITIES
+from statistics_cache import statistics_cache, bump_orders_version, create_cache_versions
+from catalog import write_catalog, merge_catalog, iter_chunks, decompressed, check_encoding, MERGE_MODES, CatalogError
+from import_jobs import enqueue_import, spool_upload, file_chunks, job_status, import_worker
+from export import export_type, export_response
+from sales_feed import sales_feed
+
+
+def start_background_workers():
+    # Called in every server worker after the fork (see gunicorn.conf.py), not on the first request,
+    # so that queued and interrupted imports resume as soon as the service is back up.
+    import_worker.ensure_started()
+    sales_feed.ensure_started()
+
 
 @application.route('/update', methods=['POST'])
-@jwt_required()
+@roles_required('owner')
 def update():
-    jwt_data = get_jwt()
-    if 'owner' not in jwt_data.get('roles', []):
-        return jsonify({"msg": "Missing Authorization Header"}), 401
-
     if 'file' not in request.files:
         return jsonify({"message": "Field file is missing."}), 400
 
     file = request.files['file']
 
+    mode = request.values.get('mode', 'insert')
+    if mode != 'insert' and mode not in MERGE_MODES:
+        return jsonify({"message": "Invalid mode."}), 400
+
+    encoding = file.headers.get('Content-Encoding')
+    try:
+        check_encoding(encoding)
+    except CatalogError as error:
+        return jsonify({"message": str(error)}), 400
+
+    if request.values.get('async', '').lower() in ('1', 'true'):
+        job = enqueue_import(file, mode)
+        return jsonify(job_status(job)), 202
+
+    file_path = None
+    chunk_size = application.config['CATALOG_CHUNK_SIZE']
+
     try:
-        content = file.stream.read().decode('utf-8')
-    except Exception:
+        if application.config['CATALOG_PARSE_WORKERS'] > 1:
+            # Parallel parsing reads byte ranges, so the upload is spooled to disk first.
+            file_path = spool_upload(file)
+            chunks = file_chunks(file_path, chunk_size)
+        else:
+            chunks = iter_chunks(decompressed(file.stream, encoding), chunk_size)
+
+        if mode in MERGE_MODES:
+            summary = merge_catalog(chunks, chunk_size, mode)
+            bump_orders_version()
+            database.session.commit()
+            return jsonify(summary), 200
+
+        write_catalog(chunks, chunk_size)
+        bump_orders_version()
+        database.session.commit()
+        return '', 200
+
+    except CatalogError as error:
+        database.session.rollback()
+        return jsonify({"message": str(error)}), 400
+
+    except UnicodeDecodeError:
+        database.session.rollback()
         return jsonify({"message": "Field file is missing."}), 400
 
-    csv_reader = csv.reader(io.StringIO(content))
+    except Exception as error:
+        database.session.rollback()
+        return jsonify({"message": str(error)}), 400
+
+    finally:
+        if file_path is not None and os.path.exists(file_path):
+            os.remove(file_path)
 
-    products_to_add = []
 
-    line_num = 0
-    for row in csv_reader:
-        if len(row) != 3:
-            return jsonify({"message": "Incorrect number of values on line %d." % line_num}), 400
+@application.route('/update/<int:job_id>', methods=['GET'])
+@roles_required('owner')
+def update_status(job_id):
+    job = database.session.get(ImportJob, job_id)
 
-        categories_str, product_name, price_str = row
+    if not job:
+        return jsonify({"message": "Invalid job id."}), 400
 
-        try:
-            price = float(price_str)
-            if price <= 0:
-                raise ValueError
-        except ValueError:
-            return jsonify({"message": "Incorrect price on line %d." % line_num}), 400
+    return jsonify(job_status(job)), 200
 
-        category_names = [cat.strip() for cat in categories_str.split('|') if cat.strip()]
 
-        products_to_add.append({
-            'name': product_name.strip(),
-            'price': price,
-            'categories': category_names,
-            'line_number': line_num
-        })
+DEFAULT_STATISTICS_LIMIT = 20
+MAX_STATISTICS_LIMIT = 1000
 
-        line_num += 1
 
-    for product_data in products_to_add:
-        existing_product = Product.query.filter_by(name=product_data['name']).first()
-        if existing_product:
-            return jsonify({"message": "Product {} already exists.".format(product_data['name'])}), 400
+def parse_timestamp(value, message):
+    # ISO 8601; naive values are UTC like Order.timestamp, offsets are converted to it.
+    if not value:
+        return None
 
     try:
-        for product_data in products_to_add:
-            product = Product(
-                name=product_data['name'],
-                price=product_data['price']
-            )
-            database.session.add(product)
-            database.session.flush()
-
-            for category_name in product_data['categories']:
-                category = Category.query.filter_by(name=category_name).first()
-                if not category:
-                    category = Category(name=category_name)
-                    database.session.add(category)
-                    database.session.flush()
-
-                product_category = ProductCategory(
-                    product_id=product.id,
-                    category_id=category.id
-                )
-                database.session.add(product_category)
+        timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(message)
 
-        database.session.commit()
-        return '', 200
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
 
-    except Exception as error:
-        database.session.rollback()
-        return jsonify({"message": str(error)}), 400
+
+def statistics_window():
+    start = parse_timestamp(request.args.get('from'), "Invalid from.")
+    end = parse_timestamp(request.args.get('to'), "Invalid to.")
+
+    granularity = request.args.get('granularity')
+    if granularity is not None and granularity not in GRANULARITIES:
+        raise ValueError("Invalid granularity.")
+
+    return start, end, granularity
+
+
+def windowed():
+    return any(request.args.get(name) for name in ('from', 'to', 'granularity'))
+
+
+PRODUCT_COLUMNS = ['name', 'sold', 'waiting']
+
+WINDOWED_PRODUCT_COLUMNS = ['name', 'sold', 'waiting', 'revenue']
+
+CATEGORY_COLUMNS = ['name', 'sold']
+
+WINDOWED_CATEGORY_COLUMNS = ['start', 'name', 'sold', 'revenue']
 
 
 @application.route('/product_statistics', methods=['GET'])
-@jwt_required()
+@roles_required('owner')
 def product_statistics():
-    user_roles = get_jwt().get('roles', [])
-    if 'owner' not in user_roles:
-        return jsonify({"msg": "Missing Authorization Header"}), 401
+    mimetype = export_type()
 
-    sold_items = database.session.query(
-        Product.name,
-        database.func.sum(OrderItem.quantity).label('total')
-    ).join(OrderItem).join(Order).filter(Order.status == 'COMPLETE').group_by(Product.name).all()
+    if not windowed():
+        if mimetype is not None:
+            return export_response(mimetype, PRODUCT_COLUMNS, product_statistics_query(), product_entry)
+        return statistics_cache.response('product_statistics', product_statistics_data)
+
+    try:
+        start, end, granularity = statistics_window()
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+
+    if mimetype is not None:
+        return export_response(
+            mimetype,
+            (['start'] if granularity is not None else []) + WINDOWED_PRODUCT_COLUMNS,
+            windowed_product_statistics_query(start, end, granularity),
+            lambda item: windowed_product_entry(item, granularity)
+        )
 
-    waiting_items = database.session.query(
+    return jsonify(windowed_product_statistics(start, end, granularity)), 200
+
+
+def product_statistics_query():
+    # Reads the incrementally maintained counters, so the cost follows the number of products, not orders.
+    return database.session.query(
         Product.name,
-        database.func.sum(OrderItem.quantity).label('total')
-    ).join(OrderItem).join(Order).filter(Order.status.in_(['CREATED', 'PENDING'])).group_by(Product.name).all()
+        ProductSalesCounter.sold,
+        ProductSalesCounter.waiting
+    ).join(ProductSalesCounter, ProductSalesCounter.product_id == Product.id)\
+     .filter(database.or_(ProductSalesCounter.sold > 0, ProductSalesCounter.waiting > 0))
 
-    sold_dict = {item.name: int(item.total) for item in sold_items}
-    waiting_dict = {item.name: int(item.total) for item in waiting_items}
 
-    all_names = set(sold_dict.keys()) | set(waiting_dict.keys())
+def product_entry(item):
+    return {
+        "name": item.name,
+        "sold": item.sold,
+        "waiting": item.waiting
+    }
 
+
+def product_statistics_data():
+    statistics = []
+    for item in product_statistics_query():
+        statistics.append(product_entry(item))
+
+    return {"statistics": statistics}
+
+
+def windowed_product_statistics_query(start, end, granularity):
+    # Totals over the window, or one entry per bucket and product when a granularity is given.
+    sold = database.func.sum(ProductSalesRollup.sold)
+    waiting = database.func.sum(ProductSalesRollup.waiting)
+    revenue = database.func.sum(ProductSalesRollup.sold_revenue)
+
+    if granularity is None:
+        return database.session.query(
+            Product.name, sold.label('sold'), waiting.label('waiting'), revenue.label('revenue')
+        ).join(ProductSalesRollup, ProductSalesRollup.product_id == Product.id)\
+         .filter(rollup_window(start, end))\
+         .group_by(Product.id, Product.name)\
+         .having(database.or_(sold > 0, waiting > 0))
+
+    return database.session.query(
+        ProductSalesRollup.bucket, Product.name, sold.label('sold'), waiting.label('waiting'), revenue.label('revenue')
+    ).join(ProductSalesRollup, ProductSalesRollup.product_id == Product.id)\
+     .filter(bucket_range(
+         granularity,
+         bucket_start(start, granularity) if start is not None else None,
+         end
+     ))\
+     .group_by(ProductSalesRollup.bucket, Product.id, Product.name)\
+     .having(database.or_(sold > 0, waiting > 0))\
+     .order_by(ProductSalesRollup.bucket, Product.name)
+
+
+def windowed_product_entry(item, granularity):
+    entry = {
+        "name": item.name,
+        "sold": int(item.sold),
+        "waiting": int(item.waiting),
+        "revenue": float(item.revenue)
+    }
+    if granularity is not None:
+        entry["start"] = item.bucket.isoformat()
+
+    return entry
+
+
+def windowed_product_statistics(start, end, granularity):
     statistics = []
-    for name in all_names:
-        statistics.append({
-            "name": name,
-            "sold": sold_dict.get(name, 0),
-            "waiting": waiting_dict.get(name, 0)
-        })
+    for item in windowed_product_statistics_query(start, end, granularity):
+        statistics.append(windowed_product_entry(item, granularity))
 
-    return jsonify({"statistics": statistics}), 200
+    return {"statistics": statistics}
 
 
 @application.route('/category_statistics', methods=['GET'])
-@jwt_required()
+@roles_required('owner')
 def category_statistics():
-    jwt_data = get_jwt()
-    if 'owner' not in jwt_data.get('roles', []):
-        return jsonify({"msg": "Missing Authorization Header"}), 401
+    try:
+        page = statistics_page()
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+
+    mimetype = export_type()
+    if mimetype is not None and page is not None:
+        return jsonify({"message": "Pagination is not supported with exports."}), 400
+
+    if not windowed():
+        if mimetype is not None:
+            return export_response(mimetype, CATEGORY_COLUMNS, ranked_category_query(*counter_category_totals()), category_entry)
+
+        if page is None:
+            return statistics_cache.response('category_statistics', category_statistics_data)
+
+        limit, cursor = page
+        if cursor is None:
+            # The dashboard's top-N page is what gets polled, so only first pages are cached.
+            return statistics_cache.response(
+                'category_statistics:top%d' % limit,
+                lambda: ranked_categories(*counter_category_totals(), limit, None)
+            )
+
+        return jsonify(ranked_categories(*counter_category_totals(), limit, cursor)), 200
+
+    try:
+        start, end, granularity = statistics_window()
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+
+    if granularity is not None:
+        if page is not None:
+            return jsonify({"message": "Pagination is not supported with granularity."}), 400
+        if mimetype is not None:
+            return export_response(
+                mimetype,
+                WINDOWED_CATEGORY_COLUMNS,
+                windowed_category_statistics_query(start, end, granularity),
+                windowed_category_entry
+            )
+        return jsonify(windowed_category_statistics(start, end, granularity)), 200
+
+    if mimetype is not None:
+        return export_response(mimetype, CATEGORY_COLUMNS, ranked_category_query(*rollup_category_totals(start, end)), category_entry)
+
+    if page is not None:
+        return jsonify(ranked_categories(*rollup_category_totals(start, end), *page)), 200
+
+    return jsonify(sorted_categories(*rollup_category_totals(start, end))), 200
+
+
+def statistics_page():
+    # limit and cursor are optional; without both the full list is returned.
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        return None
+
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_STATISTICS_LIMIT
+        if limit <= 0 or limit > MAX_STATISTICS_LIMIT:
+            raise ValueError
+    except ValueError:
+        raise ValueError("Invalid limit.")
+
+    return limit, decode_cursor(cursor) if cursor is not None else None
+
+
+def encode_cursor(total, name):
+    return base64.urlsafe_b64encode(json.dumps([total, name]).encode('utf-8')).decode('ascii').rstrip('=')
 
-    all_categories = Category.query.all()
 
-    sold_by_category = database.session.query(
+def decode_cursor(cursor):
+    try:
+        total, name = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii') + b'=' * (-len(cursor) % 4)))
+        if not isinstance(total, int) or not isinstance(name, str):
+            raise ValueError
+    except (ValueError, TypeError, UnicodeError, binascii.Error):
+        raise ValueError("Invalid cursor.")
+
+    return total, name
+
+
+def category_totals(sales_model, sales_condition, sold_column):
+    # Categories LEFT JOIN their products' sales, so categories without sales rank with zero.
+    total = database.func.coalesce(database.func.sum(sold_column), 0)
+
+    totals_query = database.session.query(
         Category.name,
-        database.func.sum(OrderItem.quantity).label('total')
-    ).join(ProductCategory, Category.id == ProductCategory.category_id)\
-     .join(Product, ProductCategory.product_id == Product.id)\
-     .join(OrderItem, Product.id == OrderItem.product_id)\
-     .join(Order, OrderItem.order_id == Order.id)\
-     .filter(Order.status == 'COMPLETE')\
-     .group_by(Category.name).all()
+        total.label('total')
+    ).outerjoin(ProductCategory, Category.id == ProductCategory.category_id)\
+     .outerjoin(sales_model, sales_condition)\
+     .group_by(Category.id, Category.name)
+
+    return totals_query, total
+
 
-    sold_dict = {cat.name: int(cat.total) for cat in sold_by_category}
+def counter_category_totals():
+    return category_totals(
+        ProductSalesCounter,
+        ProductCategory.product_id == ProductSalesCounter.product_id,
+        ProductSalesCounter.sold
+    )
 
-    category_list = []
-    for category in all_categories:
-        total_sold = sold_dict.get(category.name, 0)
-        category_list.append((category.name, total_sold))
+
+def rollup_category_totals(start, end):
+    return category_totals(
+        ProductSalesRollup,
+        database.and_(ProductCategory.product_id == ProductSalesRollup.product_id, rollup_window(start, end)),
+        ProductSalesRollup.sold
+    )
+
+
+def sorted_categories(totals_query, total):
+    category_list = [(category.name, int(category.total)) for category in totals_query.all()]
 
     category_list.sort(key=lambda x: (-x[1], x[0]))
 
     statistics = [cat[0] for cat in category_list]
 
-    return jsonify({"statistics": statistics}), 200
+    return {"statistics": statistics}
+
+
+def ranked_categories(totals_query, total, limit, cursor):
+    # Ranked and cut in SQL; the cursor is the (total, name) of the last category returned,
+    # and the next page continues strictly after it in (total DESC, name) order.
+    if cursor is not None:
+        cursor_total, cursor_name = cursor
+        totals_query = totals_query.having(database.or_(
+            total < cursor_total,
+            database.and_(total == cursor_total, Category.name > cursor_name)
+        ))
+
+    categories = ranked_category_query(totals_query, total).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(categories) > limit:
+        categories = categories[:limit]
+        next_cursor = encode_cursor(int(categories[-1].total), categories[-1].name)
+
+    return {
+        "statistics": [category.name for category in categories],
+        "nextCursor": next_cursor
+    }
+
+
+def ranked_category_query(totals_query, total):
+    return totals_query.order_by(total.desc(), Category.name)
+
+
+def category_entry(item):
+    return {
+        "name": item.name,
+        "sold": int(item.total)
+    }
+
+
+def category_statistics_data():
+    return sorted_categories(*counter_category_totals())
+
+
+def windowed_category_statistics_query(start, end, granularity):
+    # One entry per bucket and category with sales in it.
+    sold = database.func.coalesce(database.func.sum(ProductSalesRollup.sold), 0)
+    revenue = database.func.coalesce(database.func.sum(ProductSalesRollup.sold_revenue), 0)
+
+    return database.session.query(
+        ProductSalesRollup.bucket, Category.name, sold.label('sold'), revenue.label('revenue')
+    ).join(ProductCategory, ProductCategory.product_id == ProductSalesRollup.product_id)\
+     .join(Category, Category.id == ProductCategory.category_id)\
+     .filter(bucket_range(
+         granularity,
+         bucket_start(start, granularity) if start is not None else None,
+         end
+     ))\
+     .group_by(ProductSalesRollup.bucket, Category.id, Category.name)\
+     .having(sold > 0)\
+     .order_by(ProductSalesRollup.bucket, sold.desc(), Category.name)
+
+
+def windowed_category_entry(item):
+    return {
+        "start": item.bucket.isoformat(),
+        "name": item.name,
+        "sold": int(item.sold),
+        "revenue": float(item.revenue)
+    }
+
+
+def windowed_category_statistics(start, end, granularity):
+    statistics = []
+    for item in windowed_category_statistics_query(start, end, granularity):
+        statistics.append(windowed_category_entry(item))
+
+    return {"statistics": statistics}
+
+
+@application.route('/statistics_events', methods=['GET'])
+@roles_required('owner')
+def statistics_events():
+    # Server-Sent Events: a snapshot of the counters, then their changes. A reconnecting client
+    # sends Last-Event-ID and continues from there.
+    last_event_id = request.headers.get('Last-Event-ID')
+    try:
+        last_version = int(last_event_id) if last_event_id else None
+        if last_version is not None and last_version < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({"message": "Invalid Last-Event-ID."}), 400
+
+    if not sales_feed.acquire():
+        return jsonify({"message": "Too many event streams."}), 503, {'Retry-After': '5'}
+
+    return sales_feed.response(last_version)
+
+
+@application.route('/metrics', methods=['GET'])
+@roles_required('owner')
+def metrics():
+    return jsonify({
+        "database_pool": pool_statistics(database.engines),
+        "statistics_cache": statistics_cache.statistics(),
+        "sales_events": sales_feed.statistics()
+    }), 200
+
+
+@application.cli.command('init-db')
+def init_db_command():
+    create_tables()
+    create_statistics_indexes()
+    create_cache_versions()
+
+    # Backfills the counters and rollups the first time they are deployed against an existing order history.
+    if (not ProductSalesCounter.query.first() or not ProductSalesRollup.query.first()) and OrderItem.query.first():
+        rebuild_counters()
+        # Rebuilt counters have no events behind them; open streams start over from a snapshot.
+        advance_events_horizon(bump_orders_version())
+        database.session.commit()
+
+
+@application.cli.command('rebuild-sales-counters')
+@click.option('--verify', is_flag=True, help="Only compare the counters with the order tables.")
+def rebuild_sales_counters_command(verify):
+    if not verify:
+        rebuild_counters()
+        advance_events_horizon(bump_orders_version())
+        database.session.commit()
+
+    mismatches = verify_counters()
+    for product_id, expected, actual in mismatches:
+        click.echo("product %d: expected sold=%d waiting=%d, counters sold=%d waiting=%d" % ((product_id,) + expected + actual))
+
+    rollup_mismatches = verify_rollups()
+    for granularity, bucket, product_id in rollup_mismatches:
+        click.echo("rollup %s %s product %d differs from the order tables" % (granularity, bucket.isoformat(), product_id))
+
+    click.echo("%d mismatched products, %d mismatched rollup rows" % (len(mismatches), len(rollup_mismatches)))
+    if mismatches or rollup_mismatches:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
     with application.app_context():
-        database.create_all()
+        create_tables()
+
+    # The debug reloader serves from a child process; only that one runs the background threads.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
 
     application.run(host='0.0.0.0', port=5000, debug=True)
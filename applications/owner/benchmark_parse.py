@@ -0,0 +1,45 @@
+import argparse
+import sys
+import os
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from configuration import application
+from catalog import iter_file_chunks
+from benchmark_update import generate_catalog
+
+parser = argparse.ArgumentParser(
+    description="Measures catalog CSV parsing and validation throughput for different numbers of parser processes"
+)
+
+parser.add_argument("--rows", type=int, default=1000000, help="Products in the generated catalog")
+parser.add_argument("--categories", type=int, default=500, help="Distinct categories in the generated catalog")
+parser.add_argument("--per-product", type=int, default=3, help="Categories per product")
+parser.add_argument("--chunk-size", type=int, default=application.config['CATALOG_CHUNK_SIZE'], help="Rows per chunk")
+parser.add_argument("--range-size", type=int, default=application.config['CATALOG_PARSE_RANGE_SIZE'], help="Bytes per parser task")
+parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Parser process counts to compare")
+
+
+if __name__ == '__main__':
+    arguments = parser.parse_args()
+
+    catalog = generate_catalog(arguments.rows, arguments.categories, arguments.per_product)
+
+    with tempfile.NamedTemporaryFile(suffix='.csv') as file:
+        file.write(catalog.getvalue())
+        file.flush()
+
+        print("rows: %d, size: %.1f MB, chunk size: %d" % (arguments.rows, file.tell() / 1e6, arguments.chunk_size))
+
+        for workers in arguments.workers:
+            # The first pass starts the pool processes, so it is not timed.
+            for _ in iter_file_chunks(file.name, arguments.chunk_size, workers, arguments.range_size):
+                pass
+
+            start = time.perf_counter()
+            rows = sum(len(chunk) for chunk in iter_file_chunks(file.name, arguments.chunk_size, workers, arguments.range_size))
+            elapsed = time.perf_counter() - start
+
+            print("workers: %d, elapsed: %.2f s, throughput: %.0f rows/s" % (workers, elapsed, rows / elapsed))
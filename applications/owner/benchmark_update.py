@@ -0,0 +1,74 @@
+import argparse
+import io
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from configuration import application, database
+from catalog import import_catalog, merge_catalog, iter_chunks, MERGE_MODES
+
+parser = argparse.ArgumentParser(
+    description="Measures /update ingestion throughput against the configured database"
+)
+
+parser.add_argument("--rows", type=int, default=100000, help="Products in the generated catalog")
+parser.add_argument("--categories", type=int, default=500, help="Distinct categories in the generated catalog")
+parser.add_argument("--per-product", type=int, default=3, help="Categories per product")
+parser.add_argument("--chunk-size", type=int, default=application.config['CATALOG_CHUNK_SIZE'], help="Rows per chunk")
+parser.add_argument("--mode", choices=sorted(MERGE_MODES), help="Import the catalog first, then time re-uploading it with every --changed-every'th product repriced in this mode")
+parser.add_argument("--changed-every", type=int, default=1, help="Reprice one product in this many when re-uploading")
+parser.add_argument("--commit", action="store_true", help="Keep the generated products instead of rolling back")
+
+
+def generate_catalog(rows, categories, per_product, run=None, changed_every=0):
+    run = run if run is not None else int(time.time())
+
+    lines = []
+    for index in range(rows):
+        names = "|".join("benchmark-category-%d" % ((index + offset) % categories) for offset in range(per_product))
+        price = index % 1000 + 1
+        if changed_every and index % changed_every == 0:
+            price = price % 1000 + 1
+        lines.append("%s,benchmark-product-%d-%d,%d.99\n" % (names, run, index, price))
+
+    return io.BytesIO("".join(lines).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    arguments = parser.parse_args()
+
+    run = int(time.time())
+    catalog = generate_catalog(arguments.rows, arguments.categories, arguments.per_product, run)
+
+    with application.app_context():
+        database.create_all()
+
+        if arguments.mode:
+            import_catalog(catalog, arguments.chunk_size)
+            database.session.flush()
+            catalog = generate_catalog(
+                arguments.rows, arguments.categories, arguments.per_product, run, changed_every=arguments.changed_every
+            )
+
+        summary = None
+        start = time.perf_counter()
+        if arguments.mode:
+            summary = merge_catalog(iter_chunks(catalog, arguments.chunk_size), arguments.chunk_size, arguments.mode)
+        else:
+            import_catalog(catalog, arguments.chunk_size)
+
+        if arguments.commit:
+            database.session.commit()
+        else:
+            database.session.flush()
+        elapsed = time.perf_counter() - start
+
+        if not arguments.commit:
+            database.session.rollback()
+
+    print("rows: %d, chunk size: %d" % (arguments.rows, arguments.chunk_size))
+    if summary:
+        print("inserted: %(inserted)d, updated: %(updated)d, unchanged: %(unchanged)d" % summary)
+    print("elapsed: %.2f s, throughput: %.0f rows/s" % (elapsed, arguments.rows / elapsed))
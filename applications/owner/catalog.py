@@ -0,0 +1,568 @@
+import codecs
+import csv
+import gzip
+import hashlib
+import json
+import math
+import os
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import insert, update, tuple_
+from sqlalchemy.dialects import mysql, sqlite
+from configuration import database
+from models import Product, Category, ProductCategory, ProductHash
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_SIZE = 64 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+CONTENT_ENCODINGS = ('identity', 'gzip', 'zstd')
+
+
+class CatalogError(Exception):
+    pass
+
+
+def detect_encoding(stream):
+    head = stream.read(len(ZSTD_MAGIC))
+    stream.seek(0)
+
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def decompressed(stream, encoding=None):
+    # Wraps a compressed upload in a reader that inflates it block by block as the CSV is read.
+    encoding = (encoding or detect_encoding(stream) or 'identity').lower()
+
+    if encoding == 'identity':
+        return stream
+
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise CatalogError("Zstandard compressed uploads are not supported.")
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+
+    raise CatalogError("Unsupported content encoding {}.".format(encoding))
+
+
+def check_encoding(encoding):
+    # Spooled uploads are detected by magic bytes later, so a declared encoding is checked up front.
+    if encoding and encoding.lower() not in CONTENT_ENCODINGS:
+        raise CatalogError("Unsupported content encoding {}.".format(encoding))
+
+
+def iter_lines(stream):
+    # Decodes the upload block by block; a multi-byte character split across blocks is carried over.
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+
+    while True:
+        block = stream.read(READ_SIZE)
+        pending += decoder.decode(block, final=not block)
+
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+        if not block:
+            break
+
+    if pending:
+        yield pending
+
+
+def parse_row(row, line_number):
+    if len(row) != 3:
+        raise CatalogError("Incorrect number of values on line %d." % line_number)
+
+    categories_str, product_name, price_str = row
+
+    try:
+        price = float(price_str)
+        if price <= 0:
+            raise ValueError
+    except ValueError:
+        raise CatalogError("Incorrect price on line %d." % line_number)
+
+    return {
+        'name': product_name.strip(),
+        'price': price,
+        'categories': [cat.strip() for cat in categories_str.split('|') if cat.strip()],
+        'line_number': line_number
+    }
+
+
+def iter_rows(stream):
+    for line_number, row in enumerate(csv.reader(iter_lines(stream))):
+        yield parse_row(row, line_number)
+
+
+def iter_batches(rows, chunk_size):
+    chunk = []
+
+    for product_data in rows:
+        chunk.append(product_data)
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def iter_chunks(stream, chunk_size):
+    return iter_batches(iter_rows(stream), chunk_size)
+
+
+def split_ranges(path, range_size):
+    # Byte ranges ending on a line boundary; b'\n' never occurs inside a multi-byte UTF-8
+    # character. Quoted values spanning several lines are not supported by this splitting.
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as stream:
+        start = 0
+        while start < size:
+            stream.seek(start + range_size)
+            stream.readline()
+            end = min(stream.tell(), size)
+
+            yield start, end
+            start = end
+
+
+def parse_range(path, start, end):
+    # Runs in a pool process. Rows are returned as columns with category tuples shared between
+    # rows, which keeps pickling cheap for the parent. On an invalid row the raw row is returned
+    # with its index in the range, so that the parent raises the error with the file's line number.
+    with open(path, 'rb') as stream:
+        stream.seek(start)
+        lines = stream.read(end - start).decode('utf-8').split('\n')
+
+    pending = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if pending:
+        lines.append(pending)
+
+    names, prices, categories = [], [], []
+    shared_categories = {}
+
+    for line_number, row in enumerate(csv.reader(lines)):
+        try:
+            product_data = parse_row(row, line_number)
+        except CatalogError:
+            return (names, prices, categories), row
+
+        key = tuple(product_data['categories'])
+        names.append(product_data['name'])
+        prices.append(product_data['price'])
+        categories.append(shared_categories.setdefault(key, key))
+
+    return (names, prices, categories), None
+
+
+class ParserPool:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_key = None
+
+    def get(self, workers):
+        # Created lazily and per process, so forked server workers never share a pool.
+        with self._lock:
+            if self._pool is None or self._pool_key != (os.getpid(), workers):
+                if self._pool is not None and self._pool_key[0] == os.getpid():
+                    self._pool.shutdown(wait=False)
+                self._pool = ProcessPoolExecutor(max_workers=workers)
+                self._pool_key = (os.getpid(), workers)
+            return self._pool
+
+    def discard(self):
+        with self._lock:
+            self._pool = None
+
+
+parser_pool = ParserPool()
+
+
+def iter_parallel_rows(path, workers, range_size):
+    # Ranges are parsed out of order but merged in file order, with at most two ranges per
+    # process in flight, so the first error reported is the same as in a sequential parse.
+    pool = parser_pool.get(workers)
+    ranges = split_ranges(path, range_size)
+    futures = deque()
+    offset = 0
+
+    def submit_next():
+        for start, end in ranges:
+            futures.append(pool.submit(parse_range, path, start, end))
+            return
+
+    try:
+        for _ in range(workers * 2):
+            submit_next()
+
+        while futures:
+            (names, prices, categories), invalid_row = futures.popleft().result()
+            submit_next()
+
+            for line_number, product_data in enumerate(zip(names, prices, categories), offset):
+                yield {
+                    'name': product_data[0],
+                    'price': product_data[1],
+                    'categories': product_data[2],
+                    'line_number': line_number
+                }
+
+            offset += len(names)
+            if invalid_row is not None:
+                parse_row(invalid_row, offset)
+
+    except BrokenProcessPool:
+        parser_pool.discard()
+        raise
+
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def iter_file_chunks(path, chunk_size, workers, range_size):
+    with open(path, 'rb') as stream:
+        # A compressed file has no line boundaries to split on, so it is always parsed sequentially.
+        encoding = detect_encoding(stream)
+        if workers <= 1 or encoding is not None:
+            yield from iter_chunks(decompressed(stream, encoding), chunk_size)
+            return
+
+    yield from iter_batches(iter_parallel_rows(path, workers, range_size), chunk_size)
+
+
+def name_key(name):
+    # Names are unique under MySQL's default utf8mb4_0900_ai_ci collation, which ignores case and
+    # accents, so "Apple" from the database is the row an IN query matched for "apple". Every
+    # name -> id map is keyed the same way.
+    decomposed = unicodedata.normalize('NFKD', name)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+def load_category_ids(names, category_ids, chunk_size):
+    for start in range(0, len(names), chunk_size):
+        for category_id, name in database.session.query(Category.id, Category.name).filter(
+            Category.name.in_(names[start:start + chunk_size])
+        ):
+            category_ids[name_key(name)] = category_id
+
+
+def resolve_categories(names, category_ids, chunk_size):
+    # category_ids maps name_key(name) -> id for every category seen during this upload.
+    missing = {}
+    for name in names:
+        key = name_key(name)
+        if key not in category_ids:
+            missing.setdefault(key, name)
+
+    load_category_ids(sorted(missing.values()), category_ids, chunk_size)
+
+    new_names = [name for key, name in sorted(missing.items()) if key not in category_ids]
+    if new_names:
+        database.session.execute(insert(Category), [{'name': name} for name in new_names])
+        load_category_ids(new_names, category_ids, chunk_size)
+
+
+def first_existing_name(chunk):
+    existing_keys = set(name_key(name) for (name,) in database.session.query(Product.name).filter(
+        Product.name.in_([product_data['name'] for product_data in chunk])
+    ))
+
+    for product_data in chunk:
+        if name_key(product_data['name']) in existing_keys:
+            return product_data['name']
+
+    return None
+
+
+def write_chunk(chunk, category_ids, chunk_size):
+    # Returns the name of the first product that already exists, without writing anything.
+    existing_name = first_existing_name(chunk)
+    if existing_name is not None:
+        return existing_name
+
+    names = [product_data['name'] for product_data in chunk]
+
+    resolve_categories(
+        [name for product_data in chunk for name in product_data['categories']],
+        category_ids,
+        chunk_size
+    )
+
+    # Multi-row INSERT, then one IN query for the generated ids (MySQL has no INSERT ... RETURNING).
+    database.session.execute(insert(Product), [
+        {'name': product_data['name'], 'price': product_data['price']} for product_data in chunk
+    ])
+
+    product_ids = {}
+    load_product_ids(names, product_ids)
+
+    links = [
+        {'product_id': product_ids[name_key(product_data['name'])], 'category_id': category_ids[name_key(category_name)]}
+        for product_data in chunk
+        for category_name in product_data['categories']
+    ]
+    if links:
+        database.session.execute(insert(ProductCategory), links)
+
+    database.session.execute(insert(ProductHash), [
+        {'product_id': product_ids[name_key(product_data['name'])], 'hash': content_hash(product_data)}
+        for product_data in chunk
+    ])
+
+    return None
+
+
+def write_catalog(chunks, chunk_size):
+    # Writes chunk by chunk inside the caller's transaction. Like the original
+    # whole-file check, a format error anywhere in the file wins over an existing product.
+    existing_name = None
+    category_ids = {}
+
+    for chunk in chunks:
+        if existing_name is None:
+            existing_name = write_chunk(chunk, category_ids, chunk_size)
+
+    if existing_name is not None:
+        raise CatalogError("Product {} already exists.".format(existing_name))
+
+
+def import_catalog(stream, chunk_size):
+    write_catalog(iter_chunks(stream, chunk_size), chunk_size)
+
+
+def same_price(stored, price):
+    # Product.price is a MySQL FLOAT, so a stored price only matches the uploaded one to single precision.
+    return math.isclose(stored, price, rel_tol=1e-6)
+
+
+def content_hash(product_data):
+    # Identifies what an upload row would leave in the database: name, price and the set of categories.
+    content = json.dumps([product_data['name'], product_data['price'], sorted(set(product_data['categories']))])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def upsert_rows(model, key_column, update_column, rows):
+    # INSERT ... ON DUPLICATE KEY UPDATE on MySQL; the SQLite equivalent keeps the benchmarks runnable.
+    if database.engine.dialect.name == 'mysql':
+        statement = mysql.insert(model)
+        statement = statement.on_duplicate_key_update({update_column.name: statement.inserted[update_column.name]})
+    else:
+        statement = sqlite.insert(model)
+        statement = statement.on_conflict_do_update(
+            index_elements=[key_column],
+            set_={update_column.name: statement.excluded[update_column.name]}
+        )
+
+    database.session.execute(statement, rows)
+
+
+def merge_duplicates(chunk):
+    # Keyed by name_key(name). A name repeated within the chunk keeps its first spelling, its last
+    # price and the union of its categories.
+    products = {}
+    for product_data in chunk:
+        merged = products.setdefault(name_key(product_data['name']), {
+            'name': product_data['name'], 'categories': [], 'category_keys': set()
+        })
+        merged['price'] = product_data['price']
+        for category_name in product_data['categories']:
+            if name_key(category_name) not in merged['category_keys']:
+                merged['category_keys'].add(name_key(category_name))
+                merged['categories'].append(category_name)
+
+    for merged in products.values():
+        del merged['category_keys']
+
+    return products
+
+
+def load_product_ids(names, product_ids):
+    product_ids.update((name_key(name), product_id) for product_id, name in database.session.query(Product.id, Product.name).filter(
+        Product.name.in_(names)
+    ))
+
+
+def insert_links_ignoring_duplicates(links):
+    prefix = 'IGNORE' if database.engine.dialect.name == 'mysql' else 'OR IGNORE'
+    database.session.execute(insert(ProductCategory).prefix_with(prefix), links)
+
+
+def upsert_chunk(chunk, category_ids, chunk_size, summary):
+    products = merge_duplicates(chunk)
+
+    existing = dict((name_key(name), (product_id, price)) for product_id, name, price in database.session.query(
+        Product.id, Product.name, Product.price
+    ).filter(Product.name.in_([product_data['name'] for product_data in products.values()])))
+
+    resolve_categories(
+        [name for product_data in products.values() for name in product_data['categories']],
+        category_ids,
+        chunk_size
+    )
+
+    # Unchanged rows are left out of the upsert entirely.
+    changed_keys = set(
+        key for key, product_data in products.items()
+        if key not in existing or not same_price(existing[key][1], product_data['price'])
+    )
+    if changed_keys:
+        upsert_rows(Product, Product.name, Product.price, [
+            {'name': product_data['name'], 'price': product_data['price']}
+            for key, product_data in products.items() if key in changed_keys
+        ])
+
+    product_ids = dict((key, product_id) for key, (product_id, price) in existing.items())
+    new_keys = [key for key in products if key not in existing]
+    if new_keys:
+        load_product_ids([products[key]['name'] for key in new_keys], product_ids)
+
+    existing_links = set()
+    if existing:
+        existing_links = set(database.session.query(ProductCategory.product_id, ProductCategory.category_id).filter(
+            ProductCategory.product_id.in_(list(product_ids[key] for key in existing))
+        ))
+
+    links = [
+        {'product_id': product_ids[key], 'category_id': category_ids[name_key(category_name)]}
+        for key, product_data in products.items()
+        for category_name in product_data['categories']
+        if (product_ids[key], category_ids[name_key(category_name)]) not in existing_links
+    ]
+    if links:
+        insert_links_ignoring_duplicates(links)
+
+    linked_ids = set(link['product_id'] for link in links)
+    updated_ids = []
+
+    for key in products:
+        if key not in existing:
+            summary['inserted'] += 1
+        elif key in changed_keys or product_ids[key] in linked_ids:
+            summary['updated'] += 1
+            updated_ids.append(product_ids[key])
+        else:
+            summary['unchanged'] += 1
+
+    # Merged categories no longer match any upload row, so the content hash of an updated product
+    # is dropped and the next diff import rewrites it. New products hold exactly what was uploaded.
+    if updated_ids:
+        database.session.query(ProductHash).filter(
+            ProductHash.product_id.in_(updated_ids)
+        ).delete(synchronize_session=False)
+
+    if new_keys:
+        upsert_rows(ProductHash, ProductHash.product_id, ProductHash.hash, [
+            {'product_id': product_ids[key], 'hash': content_hash(products[key])} for key in new_keys
+        ])
+
+
+def diff_chunk(chunk, category_ids, chunk_size, summary):
+    # Only products whose content hash differs from the stored one are written; their price and
+    # categories are set to exactly what the upload contains.
+    products = merge_duplicates(chunk)
+    hashes = dict((key, content_hash(product_data)) for key, product_data in products.items())
+
+    existing = dict((name_key(name), (product_id, stored_hash)) for product_id, name, stored_hash in database.session.query(
+        Product.id, Product.name, ProductHash.hash
+    ).outerjoin(ProductHash, ProductHash.product_id == Product.id).filter(
+        Product.name.in_([product_data['name'] for product_data in products.values()])
+    ))
+
+    new_keys = [key for key in products if key not in existing]
+    changed_keys = [key for key in products if key in existing and existing[key][1] != hashes[key]]
+
+    summary['inserted'] += len(new_keys)
+    summary['updated'] += len(changed_keys)
+    summary['unchanged'] += len(products) - len(new_keys) - len(changed_keys)
+
+    if not new_keys and not changed_keys:
+        return
+
+    resolve_categories(
+        [name for key in new_keys + changed_keys for name in products[key]['categories']],
+        category_ids,
+        chunk_size
+    )
+
+    product_ids = dict((key, product_id) for key, (product_id, stored_hash) in existing.items())
+
+    if new_keys:
+        database.session.execute(insert(Product), [
+            {'name': products[key]['name'], 'price': products[key]['price']} for key in new_keys
+        ])
+        load_product_ids([products[key]['name'] for key in new_keys], product_ids)
+
+    current_links = set()
+    if changed_keys:
+        database.session.execute(update(Product), [
+            {'id': product_ids[key], 'price': products[key]['price']} for key in changed_keys
+        ])
+        current_links = set(database.session.query(ProductCategory.product_id, ProductCategory.category_id).filter(
+            ProductCategory.product_id.in_([product_ids[key] for key in changed_keys])
+        ))
+
+    wanted_links = set(
+        (product_ids[key], category_ids[name_key(category_name)])
+        for key in new_keys + changed_keys
+        for category_name in products[key]['categories']
+    )
+
+    removed_links = current_links - wanted_links
+    if removed_links:
+        database.session.query(ProductCategory).filter(
+            tuple_(ProductCategory.product_id, ProductCategory.category_id).in_(sorted(removed_links))
+        ).delete(synchronize_session=False)
+
+    added_links = wanted_links - current_links
+    if added_links:
+        database.session.execute(insert(ProductCategory), [
+            {'product_id': product_id, 'category_id': category_id} for product_id, category_id in sorted(added_links)
+        ])
+
+    upsert_rows(ProductHash, ProductHash.product_id, ProductHash.hash, [
+        {'product_id': product_ids[key], 'hash': hashes[key]} for key in new_keys + changed_keys
+    ])
+
+
+MERGE_MODES = {
+    'upsert': upsert_chunk,
+    'diff': diff_chunk
+}
+
+
+def merge_catalog(chunks, chunk_size, mode):
+    # Unlike write_catalog, existing products are updated instead of rejecting the file.
+    merge_chunk = MERGE_MODES[mode]
+    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    category_ids = {}
+
+    for chunk in chunks:
+        merge_chunk(chunk, category_ids, chunk_size, summary)
+
+    return summary
@@ -0,0 +1,63 @@
+import csv
+import json
+from flask import Response, request, stream_with_context
+
+EXPORT_TYPES = ['application/x-ndjson', 'text/csv']
+
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def export_type():
+    # JSON stays the default, including for Accept: */* and browsers.
+    mimetype = request.accept_mimetypes.best_match(['application/json'] + EXPORT_TYPES)
+    return mimetype if mimetype in EXPORT_TYPES else None
+
+
+class LineWriter:
+    # csv.writer target that hands every formatted row back instead of buffering it.
+    def write(self, line):
+        return line
+
+
+def chunked(lines):
+    # Rows are sent in chunks of about EXPORT_CHUNK_SIZE rather than one write per row.
+    buffer = []
+    length = 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= EXPORT_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def entries(statistics_query, entry):
+    # A server-side cursor on MySQL; at most EXPORT_BATCH_SIZE rows are held at a time.
+    for item in statistics_query.yield_per(EXPORT_BATCH_SIZE):
+        yield entry(item)
+
+
+def export_lines(mimetype, columns, statistics_query, entry):
+    if mimetype == 'text/csv':
+        writer = csv.writer(LineWriter())
+        # The header goes out before the query runs.
+        yield writer.writerow(columns)
+        lines = (writer.writerow([row[column] for column in columns]) for row in entries(statistics_query, entry))
+    else:
+        lines = (json.dumps(row) + '\n' for row in entries(statistics_query, entry))
+
+    yield from chunked(lines)
+
+
+def export_response(mimetype, columns, statistics_query, entry):
+    # One row per line: entry(item) turns each query row into a dict with the given columns.
+    return Response(
+        stream_with_context(export_lines(mimetype, columns, statistics_query, entry)),
+        mimetype=mimetype
+    )
@@ -0,0 +1,242 @@
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from configuration import application, database
+from models import ImportJob
+from statistics_cache import bump_orders_version
+from catalog import iter_file_chunks, first_existing_name, name_key, write_chunk, MERGE_MODES, CatalogError
+
+
+class ClaimLost(Exception):
+    pass
+
+
+def spool_upload(file):
+    spool_dir = application.config['IMPORT_SPOOL_DIR']
+    os.makedirs(spool_dir, exist_ok=True)
+
+    file_path = os.path.join(spool_dir, '%s.csv' % uuid.uuid4().hex)
+    file.save(file_path)
+
+    return file_path
+
+
+def file_chunks(file_path, chunk_size):
+    return iter_file_chunks(
+        file_path,
+        chunk_size,
+        application.config['CATALOG_PARSE_WORKERS'],
+        application.config['CATALOG_PARSE_RANGE_SIZE']
+    )
+
+
+def enqueue_import(file, mode):
+    file_path = spool_upload(file)
+
+    job = ImportJob(status='QUEUED', mode=mode, file_path=file_path, created_at=datetime.utcnow())
+    database.session.add(job)
+    database.session.commit()
+
+    return job
+
+
+def job_status(job):
+    end = job.finished_at or datetime.utcnow()
+    elapsed = (end - job.started_at).total_seconds() if job.started_at else 0
+
+    return {
+        "id": job.id,
+        "status": job.status,
+        "mode": job.mode,
+        "rowsParsed": job.rows_parsed,
+        "rowsWritten": job.rows_written,
+        "inserted": job.rows_inserted,
+        "updated": job.rows_updated,
+        "unchanged": job.rows_unchanged,
+        "rowsPerSecond": job.rows_written / elapsed if elapsed > 0 else 0.0,
+        "error": job.error
+    }
+
+
+def claim_job():
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=application.config['IMPORT_JOB_STALE_SECONDS'])
+
+    claimable = database.or_(
+        ImportJob.status == 'QUEUED',
+        database.and_(ImportJob.status == 'RUNNING', ImportJob.heartbeat_at < stale)
+    )
+
+    candidate = database.session.query(ImportJob.id).filter(claimable).order_by(ImportJob.id).first()
+    if candidate is None:
+        return None
+
+    # The conditional UPDATE makes the claim atomic across worker processes. The token identifies
+    # this claim, so a worker whose job was reclaimed as stale can tell it no longer owns it.
+    claim_token = uuid.uuid4().hex
+    claimed = ImportJob.query.filter(ImportJob.id == candidate.id, claimable).update({
+        'status': 'RUNNING',
+        'heartbeat_at': now,
+        'started_at': database.func.coalesce(ImportJob.started_at, now),
+        'claim_token': claim_token
+    }, synchronize_session=False)
+    database.session.commit()
+
+    return (candidate.id, claim_token) if claimed else None
+
+
+def save_progress(job_id, claim_token, progress):
+    # Commits the caller's writes together with the progress, but only while this worker still
+    # holds the claim; otherwise they are rolled back and the job is left to its new owner.
+    progress['heartbeat_at'] = datetime.utcnow()
+    updated = ImportJob.query.filter(
+        ImportJob.id == job_id,
+        ImportJob.claim_token == claim_token
+    ).update(progress, synchronize_session=False)
+
+    if not updated:
+        database.session.rollback()
+        raise ClaimLost()
+
+    database.session.commit()
+
+
+def check_duplicates(chunk, seen_keys):
+    # Within the file itself: each product once, each of its categories once.
+    for product_data in chunk:
+        key = name_key(product_data['name'])
+        if key in seen_keys:
+            raise CatalogError("Product {} already exists.".format(product_data['name']))
+        seen_keys.add(key)
+
+        category_keys = set(name_key(category_name) for category_name in product_data['categories'])
+        if len(category_keys) != len(product_data['categories']):
+            raise CatalogError("Duplicate category on line %d." % product_data['line_number'])
+
+
+def validate_file(job, chunk_size, claim_token):
+    # Insert mode writes chunk by chunk, so everything that could make it fail halfway is checked first.
+    rows_parsed = 0
+    seen_keys = set()
+
+    for chunk in file_chunks(job.file_path, chunk_size):
+        if job.mode not in MERGE_MODES:
+            check_duplicates(chunk, seen_keys)
+
+            existing_name = first_existing_name(chunk)
+            if existing_name is not None:
+                raise CatalogError("Product {} already exists.".format(existing_name))
+
+        rows_parsed += len(chunk)
+        save_progress(job.id, claim_token, {'rows_parsed': rows_parsed})
+
+
+def write_file(job, chunk_size, claim_token):
+    category_ids = {}
+    lines_committed = job.lines_committed
+
+    for chunk in file_chunks(job.file_path, chunk_size):
+        # Rows below lines_committed were written before a restart.
+        chunk = [product_data for product_data in chunk if product_data['line_number'] >= lines_committed]
+        if not chunk:
+            continue
+
+        summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        if job.mode in MERGE_MODES:
+            MERGE_MODES[job.mode](chunk, category_ids, chunk_size, summary)
+        else:
+            existing_name = write_chunk(chunk, category_ids, chunk_size)
+            if existing_name is not None:
+                raise CatalogError("Product {} already exists.".format(existing_name))
+
+            summary['inserted'] = len(chunk)
+
+        # Progress is committed together with the chunk, so it is always a valid resume point.
+        lines_committed = chunk[-1]['line_number'] + 1
+        bump_orders_version()
+        save_progress(job.id, claim_token, {
+            'rows_written': ImportJob.rows_written + len(chunk),
+            'rows_inserted': ImportJob.rows_inserted + summary['inserted'],
+            'rows_updated': ImportJob.rows_updated + summary['updated'],
+            'rows_unchanged': ImportJob.rows_unchanged + summary['unchanged'],
+            'lines_committed': lines_committed
+        })
+
+
+def finish_job(job_id, claim_token, status, error=None):
+    finished = ImportJob.query.filter(
+        ImportJob.id == job_id,
+        ImportJob.claim_token == claim_token
+    ).update({'status': status, 'error': error, 'finished_at': datetime.utcnow()}, synchronize_session=False)
+    database.session.commit()
+
+    # A job reclaimed by another worker still needs its file.
+    file_path = database.session.query(ImportJob.file_path).filter(ImportJob.id == job_id).scalar()
+    if finished and os.path.exists(file_path):
+        os.remove(file_path)
+
+
+def run_job(job_id, claim_token):
+    chunk_size = application.config['CATALOG_CHUNK_SIZE']
+    job = database.session.get(ImportJob, job_id)
+
+    try:
+        if job.lines_committed == 0:
+            validate_file(job, chunk_size, claim_token)
+        write_file(job, chunk_size, claim_token)
+
+    except ClaimLost:
+        database.session.rollback()
+
+    except CatalogError as error:
+        database.session.rollback()
+        finish_job(job_id, claim_token, 'FAILED', str(error))
+
+    except UnicodeDecodeError:
+        database.session.rollback()
+        finish_job(job_id, claim_token, 'FAILED', "Field file is missing.")
+
+    except Exception as error:
+        database.session.rollback()
+        finish_job(job_id, claim_token, 'FAILED', str(error))
+
+    else:
+        finish_job(job_id, claim_token, 'COMPLETE')
+
+
+class ImportWorker:
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        # Threads do not survive a fork, so every server worker starts its own.
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            threading.Thread(target=self._run, name='import-worker', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                with application.app_context():
+                    claim = claim_job()
+                    if claim is not None:
+                        run_job(*claim)
+                        continue
+            except Exception as error:
+                print("[ERROR] Import worker: %s" % error)
+
+            time.sleep(self.poll_interval)
+
+
+import_worker = ImportWorker(application.config['IMPORT_POLL_INTERVAL'])
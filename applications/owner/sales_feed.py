@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import Response, stream_with_context
+from configuration import application, database
+from models import Product, ProductSalesCounter
+from sales import events_horizon, latest_events_version, sales_changes, prune_sales_events
+
+RETRY_MILLISECONDS = 3000
+
+
+def event_message(name, version, data):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (version, name, json.dumps(data))
+
+
+def snapshot_message():
+    # The version and the counters are read in one transaction, a consistent snapshot on MySQL,
+    # so the deltas that follow start exactly where the snapshot ends.
+    version = latest_events_version()
+
+    statistics_query = database.session.query(
+        Product.id,
+        Product.name,
+        ProductSalesCounter.sold,
+        ProductSalesCounter.waiting
+    ).join(ProductSalesCounter, ProductSalesCounter.product_id == Product.id)\
+     .filter(database.or_(ProductSalesCounter.sold > 0, ProductSalesCounter.waiting > 0))
+
+    statistics = []
+    for item in statistics_query:
+        statistics.append({
+            "id": item.id,
+            "name": item.name,
+            "sold": item.sold,
+            "waiting": item.waiting
+        })
+
+    return version, event_message('snapshot', version, {"statistics": statistics})
+
+
+def next_message(last_version, latest_version):
+    # Returns the stream's new version and the message to send, if any.
+    if last_version is None or last_version < events_horizon():
+        return snapshot_message()
+
+    if latest_version is None or latest_version <= last_version:
+        return last_version, None
+
+    changes = []
+    for item in sales_changes(last_version, latest_version):
+        changes.append({
+            "id": item.product_id,
+            "name": item.name,
+            "sold": int(item.sold),
+            "waiting": int(item.waiting)
+        })
+
+    if not changes:
+        return latest_version, None
+
+    return latest_version, event_message('sales', latest_version, {"changes": changes})
+
+
+class SalesEventFeed:
+    # One thread per worker process polls for the latest event version and wakes the streams;
+    # each stream then reads everything since its own last version as one coalesced message.
+
+    def __init__(self, poll_interval, heartbeat_interval, max_streams, retention_seconds, prune_interval):
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.max_streams = max_streams
+        self.retention_seconds = retention_seconds
+        self.prune_interval = prune_interval
+        self.streams = 0
+        self.rejected = 0
+        self._latest_version = None
+        self._condition = threading.Condition()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        # Threads do not survive a fork, so every server worker starts its own.
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            threading.Thread(target=self._run, name='sales-event-feed', daemon=True).start()
+            self._pid = os.getpid()
+
+    def acquire(self):
+        # Every stream holds a server thread, so only max_streams of them may run per process.
+        with self._condition:
+            if self.streams >= self.max_streams:
+                self.rejected += 1
+                return False
+
+            self.streams += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.streams -= 1
+
+    def wait(self, version, timeout):
+        # True once the feed has seen a version after the given one, False on timeout.
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._latest_version is not None and self._latest_version > version,
+                timeout
+            )
+
+    def statistics(self):
+        return {
+            "streams": self.streams,
+            "rejected": self.rejected,
+            "latest_version": self._latest_version
+        }
+
+    def _prune(self):
+        if self.retention_seconds > 0:
+            prune_sales_events(datetime.utcnow() - timedelta(seconds=self.retention_seconds))
+            database.session.commit()
+
+    def _run(self):
+        pruned_at = None
+        while True:
+            try:
+                with application.app_context():
+                    if pruned_at is None or time.monotonic() - pruned_at >= self.prune_interval:
+                        pruned_at = time.monotonic()
+                        self._prune()
+
+                    latest_version = latest_events_version()
+
+                with self._condition:
+                    if latest_version != self._latest_version:
+                        self._latest_version = latest_version
+                        self._condition.notify_all()
+            except Exception as error:
+                print("[ERROR] Sales event feed: %s" % error)
+
+            time.sleep(self.poll_interval)
+
+    def _messages(self, last_version):
+        yield 'retry: %d\n\n' % RETRY_MILLISECONDS
+
+        while True:
+            try:
+                last_version, message = next_message(last_version, self._latest_version)
+            finally:
+                # Ends the read transaction, so the next read sees new commits and the connection
+                # goes back to the pool while the stream waits.
+                database.session.rollback()
+
+            # A slow client blocks this yield; nothing queues up meanwhile, and the next read
+            # coalesces everything it missed into one message.
+            if message is not None:
+                yield message
+
+            if not self.wait(last_version, self.heartbeat_interval):
+                # Keeps proxies from closing an idle stream and detects clients that went away.
+                yield ': heartbeat\n\n'
+
+    def response(self, last_version):
+        # The caller has acquired a slot; it is released when the server closes the response.
+        response = Response(
+            stream_with_context(self._messages(last_version)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        response.call_on_close(self.release)
+
+        return response
+
+
+sales_feed = SalesEventFeed(
+    application.config['SALES_EVENTS_POLL_INTERVAL'],
+    application.config['SALES_EVENTS_HEARTBEAT_INTERVAL'],
+    application.config['SALES_EVENTS_MAX_STREAMS'],
+    application.config['SALES_EVENTS_RETENTION_SECONDS'],
+    application.config['SALES_EVENTS_PRUNE_INTERVAL']
+)
@@ -0,0 +1,89 @@
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics:
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.closes = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def record_checkout(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_wait_avg_ms": self.checkout_wait_total * 1000 / self.checkouts if self.checkouts else 0.0,
+                "checkout_wait_max_ms": self.checkout_wait_max * 1000,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "closes": self.closes,
+                "invalidations": self.invalidations
+            }
+
+
+metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+
+    def _do_get(self):
+        # Covers both waiting for a free connection and opening a new one.
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            metrics.increment('timeouts')
+            raise
+
+        metrics.record_checkout(time.perf_counter() - start)
+        return connection
+
+
+@event.listens_for(InstrumentedQueuePool, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    metrics.increment('connects')
+
+
+@event.listens_for(InstrumentedQueuePool, 'close')
+def on_close(dbapi_connection, connection_record):
+    metrics.increment('closes')
+
+
+@event.listens_for(InstrumentedQueuePool, 'invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    metrics.increment('invalidations')
+
+
+def pool_statistics(engines):
+    statistics = metrics.snapshot()
+    statistics['pools'] = {}
+
+    for bind_key, engine in engines.items():
+        pool = engine.pool
+        statistics['pools'][bind_key or 'default'] = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(0, pool.overflow())
+        }
+
+    return statistics
@@ -0,0 +1,81 @@
+import calendar
+import hashlib
+import threading
+import time
+from configuration import application, database
+from models import TokenRevocation
+
+
+class BloomFilter:
+
+    def __init__(self, size_bits, hash_count):
+        self.size_bits = size_bits
+        self.hash_count = hash_count
+        self._bits = bytearray((size_bits + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.sha256(value.encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:16], 'little') | 1
+
+        return [(first + i * second) % self.size_bits for i in range(self.hash_count)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class RevocationList:
+
+    def __init__(self, size_bits, hash_count, refresh_interval):
+        self.filter = BloomFilter(size_bits, hash_count)
+        self.refresh_interval = refresh_interval
+        self._last_id = 0
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def _is_stale(self):
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.refresh_interval
+
+    def refresh(self):
+        if not self._is_stale():
+            return
+
+        with self._lock:
+            if not self._is_stale():
+                return
+
+            # Only rows appended since the last refresh are read; the log is never updated in place.
+            rows = database.session.query(
+                TokenRevocation.id,
+                TokenRevocation.subject
+            ).filter(TokenRevocation.id > self._last_id).order_by(TokenRevocation.id).all()
+
+            for row in rows:
+                self.filter.add(row.subject)
+                self._last_id = row.id
+
+            self._refreshed_at = time.monotonic()
+
+    def is_revoked(self, claims):
+        self.refresh()
+
+        subject = claims.get('sub')
+        if subject is None or subject not in self.filter:
+            return False
+
+        revoked_at = database.session.query(
+            database.func.max(TokenRevocation.revoked_at)
+        ).filter(TokenRevocation.subject == subject).scalar()
+
+        return revoked_at is not None and claims.get('iat', 0) <= calendar.timegm(revoked_at.utctimetuple())
+
+
+revocation_list = RevocationList(
+    application.config['REVOCATION_FILTER_BITS'],
+    application.config['REVOCATION_FILTER_HASHES'],
+    application.config['REVOCATION_REFRESH_INTERVAL']
+)
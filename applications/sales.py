@@ -0,0 +1,314 @@
+import math
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, insert
+from sqlalchemy.dialects import mysql, sqlite
+from configuration import database
+from models import Product, Order, OrderItem, ProductSalesCounter, ProductSalesRollup, SalesEvent, CacheVersion
+
+WAITING_STATUSES = ['CREATED', 'PENDING']
+
+SALES_EVENTS_HORIZON = 'sales_events_horizon'
+
+GRANULARITIES = ['hour', 'day']
+
+
+def bucket_start(timestamp, granularity):
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def bucket_range(granularity, start, end):
+    conditions = [ProductSalesRollup.granularity == granularity]
+    if start is not None:
+        conditions.append(ProductSalesRollup.bucket >= start)
+    if end is not None:
+        conditions.append(ProductSalesRollup.bucket < end)
+
+    return database.and_(*conditions)
+
+
+def rollup_window(start, end):
+    # Covers [start, end), truncated to whole hours, with daily rows for every complete day and
+    # hourly rows only at the edges, so a year-long window reads about 365 rows per product.
+    start = bucket_start(start, 'hour') if start is not None else None
+    end = bucket_start(end, 'hour') if end is not None else None
+
+    days_from = None
+    if start is not None:
+        days_from = bucket_start(start, 'day')
+        if days_from < start:
+            days_from += timedelta(days=1)
+    days_to = bucket_start(end, 'day') if end is not None else None
+
+    if days_from is not None and days_to is not None and days_from >= days_to:
+        return bucket_range('hour', start, end)
+
+    conditions = [bucket_range('day', days_from, days_to)]
+    if start is not None and start < days_from:
+        conditions.append(bucket_range('hour', start, days_from))
+    if end is not None and days_to < end:
+        conditions.append(bucket_range('hour', days_to, end))
+
+    return database.or_(*conditions)
+
+
+def product_totals(items):
+    # (product_id, quantity, price) items -> sorted (product_id, quantity, revenue).
+    totals = {}
+    for product_id, quantity, price in items:
+        total = totals.setdefault(product_id, [0, 0.0])
+        total[0] += quantity
+        total[1] += quantity * price
+
+    # Counter rows are always touched in product id order, so concurrent orders cannot deadlock on them.
+    return [(product_id, quantity, revenue) for product_id, (quantity, revenue) in sorted(totals.items())]
+
+
+def increment_rows(table, key_columns, increments, rows):
+    # INSERT ... ON DUPLICATE KEY UPDATE column = column + new value; ON CONFLICT on SQLite.
+    if database.engine.dialect.name == 'mysql':
+        statement = mysql.insert(table)
+        statement = statement.on_duplicate_key_update(dict(
+            (name, table.c[name] + statement.inserted[name]) for name in increments
+        ))
+    else:
+        statement = sqlite.insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c[name] for name in key_columns],
+            set_=dict((name, table.c[name] + statement.excluded[name]) for name in increments)
+        )
+
+    database.session.execute(statement, rows)
+
+
+def record_order(timestamp, items):
+    # Called in the order's transaction; (product_id, quantity, price) items become waiting.
+    # Returns the (product_id, sold, waiting) changes for record_sales_events().
+    totals = product_totals(items)
+
+    increment_rows(ProductSalesCounter.__table__, ['product_id'], ['waiting'], [
+        {'product_id': product_id, 'sold': 0, 'waiting': quantity}
+        for product_id, quantity, revenue in totals
+    ])
+
+    increment_rows(
+        ProductSalesRollup.__table__,
+        ['granularity', 'bucket', 'product_id'],
+        ['waiting', 'waiting_revenue'],
+        [
+            {
+                'granularity': granularity,
+                'bucket': bucket_start(timestamp, granularity),
+                'product_id': product_id,
+                'sold': 0,
+                'waiting': quantity,
+                'sold_revenue': 0.0,
+                'waiting_revenue': revenue
+            }
+            for granularity in GRANULARITIES
+            for product_id, quantity, revenue in totals
+        ]
+    )
+
+    return [(product_id, 0, quantity) for product_id, quantity, revenue in totals]
+
+
+def record_delivery(order_id):
+    # Called in the transaction that completes the order; its quantities move from waiting to sold.
+    # Returns the (product_id, sold, waiting) changes for record_sales_events().
+    order_timestamp = database.session.query(Order.timestamp).filter(Order.id == order_id).scalar()
+    totals = product_totals(database.session.query(
+        OrderItem.product_id, OrderItem.quantity, OrderItem.price
+    ).filter(OrderItem.order_id == order_id))
+
+    counters = ProductSalesCounter.__table__
+    database.session.execute(
+        counters.update().where(counters.c.product_id == bindparam('counter_product_id')).values(
+            sold=counters.c.sold + bindparam('quantity'),
+            waiting=counters.c.waiting - bindparam('quantity')
+        ),
+        [
+            {'counter_product_id': product_id, 'quantity': quantity}
+            for product_id, quantity, revenue in totals
+        ]
+    )
+
+    rollups = ProductSalesRollup.__table__
+    database.session.execute(
+        rollups.update().where(
+            rollups.c.granularity == bindparam('rollup_granularity'),
+            rollups.c.bucket == bindparam('rollup_bucket'),
+            rollups.c.product_id == bindparam('rollup_product_id')
+        ).values(
+            sold=rollups.c.sold + bindparam('quantity'),
+            waiting=rollups.c.waiting - bindparam('quantity'),
+            sold_revenue=rollups.c.sold_revenue + bindparam('revenue'),
+            waiting_revenue=rollups.c.waiting_revenue - bindparam('revenue')
+        ),
+        [
+            {
+                'rollup_granularity': granularity,
+                'rollup_bucket': bucket_start(order_timestamp, granularity),
+                'rollup_product_id': product_id,
+                'quantity': quantity,
+                'revenue': revenue
+            }
+            for granularity in GRANULARITIES
+            for product_id, quantity, revenue in totals
+        ]
+    )
+
+    return [(product_id, quantity, -quantity) for product_id, quantity, revenue in totals]
+
+
+def record_sales_events(version, changes):
+    # Called with the version returned by bump_orders_version(), in the same transaction. The version
+    # row stays locked until commit, so events become visible in version order and a reader that has
+    # seen version v can never miss a later commit of a smaller one.
+    if not changes:
+        return
+
+    created_at = datetime.utcnow()
+    database.session.execute(insert(SalesEvent.__table__), [
+        {'version': version, 'product_id': product_id, 'sold': sold, 'waiting': waiting, 'created_at': created_at}
+        for product_id, sold, waiting in changes
+    ])
+
+
+def events_horizon():
+    # Events up to this version may be gone; streams behind it start over from a snapshot.
+    return database.session.query(CacheVersion.version).filter(CacheVersion.name == SALES_EVENTS_HORIZON).scalar() or 0
+
+
+def advance_events_horizon(version):
+    updated = CacheVersion.query.filter(
+        CacheVersion.name == SALES_EVENTS_HORIZON,
+        CacheVersion.version < version
+    ).update({'version': version}, synchronize_session=False)
+
+    if not updated and database.session.get(CacheVersion, SALES_EVENTS_HORIZON) is None:
+        database.session.add(CacheVersion(name=SALES_EVENTS_HORIZON, version=version))
+
+
+def latest_events_version():
+    latest = database.session.query(database.func.max(SalesEvent.version)).scalar() or 0
+    return max(latest, events_horizon())
+
+
+def sales_changes(after, upto):
+    # Net per-product changes of every event in (after, upto], however many orders that spans.
+    sold = database.func.sum(SalesEvent.sold)
+    waiting = database.func.sum(SalesEvent.waiting)
+
+    return database.session.query(
+        SalesEvent.product_id, Product.name, sold.label('sold'), waiting.label('waiting')
+    ).join(Product, Product.id == SalesEvent.product_id)\
+     .filter(SalesEvent.version > after, SalesEvent.version <= upto)\
+     .group_by(SalesEvent.product_id, Product.name)\
+     .having(database.or_(sold != 0, waiting != 0))\
+     .order_by(SalesEvent.product_id)
+
+
+def prune_sales_events(before):
+    # Deletes events created before the given time; the caller commits.
+    version = database.session.query(database.func.max(SalesEvent.version)).filter(
+        SalesEvent.created_at < before
+    ).scalar()
+    if version is None:
+        return 0
+
+    advance_events_horizon(version)
+    return SalesEvent.query.filter(SalesEvent.version <= version).delete(synchronize_session=False)
+
+
+def sales_totals_query():
+    # The counters' definition, aggregated from the raw order tables.
+    return database.session.query(
+        OrderItem.product_id,
+        database.func.sum(database.case((Order.status == 'COMPLETE', OrderItem.quantity), else_=0)).label('sold'),
+        database.func.sum(database.case((Order.status.in_(WAITING_STATUSES), OrderItem.quantity), else_=0)).label('waiting')
+    ).join(Order, OrderItem.order_id == Order.id)\
+     .filter(Order.status.in_(['COMPLETE'] + WAITING_STATUSES))\
+     .group_by(OrderItem.product_id)
+
+
+def rollup_totals():
+    # The rollups' definition. Bucketing is done here rather than in SQL, which has no portable
+    # date truncation; order items are streamed, and only one entry per bucket and product is kept.
+    totals = {}
+
+    items = database.session.query(
+        Order.timestamp, Order.status, OrderItem.product_id, OrderItem.quantity, OrderItem.price
+    ).join(Order, OrderItem.order_id == Order.id)\
+     .filter(Order.status.in_(['COMPLETE'] + WAITING_STATUSES))\
+     .yield_per(1000)
+
+    for timestamp, status, product_id, quantity, price in items:
+        for granularity in GRANULARITIES:
+            total = totals.setdefault((granularity, bucket_start(timestamp, granularity), product_id), [0, 0, 0.0, 0.0])
+            if status == 'COMPLETE':
+                total[0] += quantity
+                total[2] += quantity * price
+            else:
+                total[1] += quantity
+                total[3] += quantity * price
+
+    return totals
+
+
+def rebuild_counters():
+    # Replaces every counter and rollup in one transaction; the caller commits.
+    database.session.query(ProductSalesCounter).delete(synchronize_session=False)
+    database.session.execute(
+        insert(ProductSalesCounter.__table__).from_select(['product_id', 'sold', 'waiting'], sales_totals_query())
+    )
+
+    database.session.query(ProductSalesRollup).delete(synchronize_session=False)
+    rows = [
+        {
+            'granularity': granularity,
+            'bucket': bucket,
+            'product_id': product_id,
+            'sold': sold,
+            'waiting': waiting,
+            'sold_revenue': sold_revenue,
+            'waiting_revenue': waiting_revenue
+        }
+        for (granularity, bucket, product_id), (sold, waiting, sold_revenue, waiting_revenue) in sorted(rollup_totals().items())
+    ]
+    for start in range(0, len(rows), 1000):
+        database.session.execute(insert(ProductSalesRollup.__table__), rows[start:start + 1000])
+
+
+def verify_counters():
+    expected = dict((product_id, (int(sold), int(waiting))) for product_id, sold, waiting in sales_totals_query())
+    actual = dict((counter.product_id, (counter.sold, counter.waiting)) for counter in ProductSalesCounter.query)
+
+    mismatches = []
+    for product_id in sorted(set(expected) | set(actual)):
+        if expected.get(product_id, (0, 0)) != actual.get(product_id, (0, 0)):
+            mismatches.append((product_id, expected.get(product_id, (0, 0)), actual.get(product_id, (0, 0))))
+
+    return mismatches
+
+
+def same_totals(expected, actual):
+    return expected[:2] == actual[:2] and all(
+        math.isclose(expected[index], actual[index], rel_tol=1e-9, abs_tol=1e-6) for index in (2, 3)
+    )
+
+
+def verify_rollups():
+    expected = rollup_totals()
+    actual = dict(
+        ((rollup.granularity, rollup.bucket, rollup.product_id), (rollup.sold, rollup.waiting, rollup.sold_revenue, rollup.waiting_revenue))
+        for rollup in ProductSalesRollup.query
+    )
+
+    empty = (0, 0, 0.0, 0.0)
+    return [
+        key for key in sorted(set(expected) | set(actual))
+        if not same_totals(tuple(expected.get(key, empty)), actual.get(key, empty))
+    ]
@@ -0,0 +1,141 @@
+import threading
+from flask import request
+from sqlalchemy.exc import IntegrityError
+from configuration import application, database
+from models import CacheVersion, StatisticsCacheEntry
+
+ORDERS_VERSION = 'orders'
+
+
+def create_cache_versions():
+    # Run by init-db, so that bump_orders_version() only ever has to UPDATE an existing row.
+    if database.session.get(CacheVersion, ORDERS_VERSION) is None:
+        try:
+            database.session.add(CacheVersion(name=ORDERS_VERSION, version=0))
+            database.session.commit()
+        except IntegrityError:
+            database.session.rollback()
+
+
+def bump_orders_version():
+    # Called inside the transaction that changes orders or the catalog, so the new version
+    # becomes visible together with the data it describes. The row stays locked until commit,
+    # so versions are committed in increasing order.
+    updated = CacheVersion.query.filter(CacheVersion.name == ORDERS_VERSION).update(
+        {'version': CacheVersion.version + 1},
+        synchronize_session=False
+    )
+    if not updated:
+        database.session.add(CacheVersion(name=ORDERS_VERSION, version=1))
+        database.session.flush()
+
+    return orders_version()
+
+
+def orders_version():
+    return database.session.query(CacheVersion.version).filter(CacheVersion.name == ORDERS_VERSION).scalar() or 0
+
+
+class LocalCacheBackend:
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None and entry[0] == version else None
+
+    def set(self, key, version, body):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < version:
+                self._entries[key] = (version, body)
+
+
+class DatabaseCacheBackend:
+    # Shared by every worker process of every owner container.
+
+    def get(self, key, version):
+        entry = database.session.query(StatisticsCacheEntry.version, StatisticsCacheEntry.body).filter(
+            StatisticsCacheEntry.key == key
+        ).first()
+        return entry.body if entry is not None and entry.version == version else None
+
+    def set(self, key, version, body):
+        # Never replaces a newer entry; a concurrent insert of the same key simply wins.
+        try:
+            updated = StatisticsCacheEntry.query.filter(
+                StatisticsCacheEntry.key == key,
+                StatisticsCacheEntry.version < version
+            ).update({'version': version, 'body': body}, synchronize_session=False)
+
+            if not updated and database.session.get(StatisticsCacheEntry, key) is None:
+                database.session.add(StatisticsCacheEntry(key=key, version=version, body=body))
+
+            database.session.commit()
+        except IntegrityError:
+            database.session.rollback()
+
+
+CACHE_BACKENDS = {
+    'local': LocalCacheBackend,
+    'database': DatabaseCacheBackend
+}
+
+
+class StatisticsCache:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def response(self, key, compute):
+        # The version is read first, so in the same transaction the aggregation sees at least that state.
+        version = orders_version()
+        etag = '%s-%d' % (key, version)
+
+        if request.if_none_match.contains(etag):
+            self.not_modified += 1
+            response = application.response_class(status=304)
+        else:
+            body = self.backend.get(key, version)
+
+            if body is None:
+                # Concurrent requests in this process wait for one aggregation instead of repeating it.
+                with self._key_lock(key):
+                    body = self.backend.get(key, version)
+                    if body is None:
+                        self.misses += 1
+                        body = application.json.dumps(compute())
+                        self.backend.set(key, version, body)
+                    else:
+                        self.hits += 1
+            else:
+                self.hits += 1
+
+            response = application.response_class(body, mimetype='application/json')
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def statistics(self):
+        return {
+            "backend": application.config['STATISTICS_CACHE_BACKEND'],
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified
+        }
+
+
+statistics_cache = StatisticsCache(CACHE_BACKENDS[application.config['STATISTICS_CACHE_BACKEND']]())
@@ -4,7 +4,8 @@ Ovo je INTERNI test fajl - ne predaje se u projektu!
 """
 
 from configuration import application, database
-from models import Product, Category, ProductCategory, Order, OrderItem, CourierAssignment
+from models import Product, Category, ProductCategory, Order, OrderItem, CourierAssignment, create_statistics_indexes
+from sales import sales_totals_query, WAITING_STATUSES
 from datetime import datetime
 
 def test_database_creation():
@@ -156,6 +157,97 @@ def test_cascade_delete():
         else:
             print("❌ CASCADE DELETE NE RADI!")
 
+def explain(query):
+    """Vraca plan izvrsavanja upita kao listu redova (MySQL EXPLAIN ili SQLite EXPLAIN QUERY PLAN)"""
+    sql = str(query.statement.compile(database.engine, compile_kwargs={"literal_binds": True}))
+
+    if database.engine.dialect.name == 'mysql':
+        return [dict(row._mapping) for row in database.session.execute(database.text('EXPLAIN ' + sql))]
+
+    return [dict(row._mapping) for row in database.session.execute(database.text('EXPLAIN QUERY PLAN ' + sql))]
+
+def plan_text(plan):
+    """Spaja sve vrednosti iz plana izvrsavanja u jedan string za proveru imena indeksa"""
+    return " ".join(str(value) for row in plan for value in row.values())
+
+def test_statistics_indexes():
+    """Test da /product_statistics upit koristi kompozitne indekse"""
+    print("\n" + "=" * 50)
+    print("TEST 6: Indeksi za statistiku")
+    print("=" * 50)
+
+    with application.app_context():
+        create_statistics_indexes()
+
+        # Planer bira indekse tek kada tabele imaju podatke i statistiku
+        products_before = Product.query.count()
+        database.session.execute(database.insert(Product), [
+            {'name': f'Statistika {i}', 'price': 1.0} for i in range(200)
+        ])
+        database.session.execute(database.insert(Order), [
+            {'customer_email': 'test@test.com', 'price': 1.0, 'status': ['CREATED', 'PENDING', 'COMPLETE'][i % 3], 'timestamp': datetime.utcnow()}
+            for i in range(2000)
+        ])
+        database.session.flush()
+
+        product_ids = [product.id for product in Product.query.offset(products_before)]
+        order_ids = [order.id for order in Order.query]
+        database.session.execute(database.insert(OrderItem), [
+            {'order_id': order_ids[i % len(order_ids)], 'product_id': product_ids[(i * 7) % len(product_ids)], 'quantity': 1, 'price': 1.0}
+            for i in range(10000)
+        ])
+        database.session.commit()
+
+        if database.engine.dialect.name == 'mysql':
+            database.session.execute(database.text('ANALYZE TABLE products, orders, order_items'))
+        else:
+            database.session.execute(database.text('ANALYZE'))
+        print("✅ Podaci za statistiku kreirani")
+
+        inspector = database.inspect(database.engine)
+        for table, index_name in [('order_items', 'ix_order_items_product_order'), ('orders', 'ix_orders_status_id')]:
+            if index_name in [index['name'] for index in inspector.get_indexes(table)]:
+                print(f"  ✅ {table}.{index_name}")
+            else:
+                print(f"  ❌ {table}.{index_name} - MISSING!")
+            assert index_name in [index['name'] for index in inspector.get_indexes(table)], index_name
+
+        # Agregacija iz tabela narudzbina koju koristi rebuild brojaca prodaje
+        query = sales_totals_query()
+
+        plan = explain(query)
+        print(f"\n📋 Plan izvrsavanja:")
+        for row in plan:
+            print(f"  - {row}")
+
+        # Spoj cita jednu tabelu preko njenog indeksa, a drugu dohvata po kljucu, pa plan celog upita
+        # navodi samo indeks strane koja vodi spoj: SQLite krece od order_items
+        # (ix_order_items_product_order) i orders cita po primarnom kljucu, dok MySQL moze da krene
+        # od orders (ix_orders_status_id) i order_items cita preko indeksa stranog kljuca order_id.
+        # Zato se svaki indeks proverava i u obliku upita za koji postoji.
+        used = plan_text(plan)
+        if 'ix_order_items_product_order' in used or 'ix_orders_status_id' in used:
+            print("✅ Plan koristi indekse za statistiku.")
+        else:
+            print("❌ Plan NE koristi indekse za statistiku!")
+        assert 'ix_order_items_product_order' in used or 'ix_orders_status_id' in used, used
+        if database.engine.dialect.name == 'sqlite':
+            assert 'ix_order_items_product_order' in used, used
+
+        # Statistika jednog proizvoda: stavke se traze po product_id
+        product_plan = plan_text(explain(query.filter(OrderItem.product_id == product_ids[0])))
+        # Narudzbine u statusima koje brojaci prate
+        status_plan = plan_text(explain(
+            database.session.query(Order.id).filter(Order.status.in_(['COMPLETE'] + WAITING_STATUSES))
+        ))
+
+        for index_name, used in [('ix_order_items_product_order', product_plan), ('ix_orders_status_id', status_plan)]:
+            if index_name in used:
+                print(f"  ✅ Plan koristi {index_name}")
+            else:
+                print(f"  ❌ Plan NE koristi {index_name}: {used}")
+            assert index_name in used, used
+
 if __name__ == '__main__':
     print("\n🧪 TESTIRANJE STORE MODELA\n")
 
@@ -164,6 +256,7 @@ if __name__ == '__main__':
     test_order_creation()
     test_courier_assignment()
     test_cascade_delete()
+    test_statistics_indexes()
 
     print("\n" + "=" * 50)
     print("✅ SVI TESTOVI ZAVRŠENI!")
@@ -0,0 +1,8 @@
+def create_app():
+    # Importing the service module registers its routes on the shared Flask application.
+    import application
+
+    return application.application
+
+
+application = create_app()
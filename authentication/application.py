@@ -1,40 +1,69 @@
 import re
+import io
+import csv
+import math
+import calendar
+from datetime import datetime
 from flask import request, jsonify
 from configuration import application, database
-from models import User
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt
-from passlib.hash import sha256_crypt
-from sqlalchemy import and_
+from models import User, AccountDeletion, TokenRevocation
+from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt
+from hashing import hash_password, hash_passwords, verify_and_update_password, HashingQueueFull
+from throttling import login_retry_after, ip_limiter, email_limiter
+from user_cache import find_user, user_cache
+from pool_metrics import pool_statistics
+from sqlalchemy import and_, insert
+from sqlalchemy.exc import IntegrityError
 
 email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
 
-@application.route('/register_customer', methods=['POST'])
-def register_customer():
-    req_data = request.get_json()
+def token_claims(user, token_type):
+    return {
+        "forename": user.forename,
+        "surname": user.surname,
+        "roles": [user.role],
+        "type": token_type
+    }
 
-    if 'forename' not in req_data or not req_data['forename']:
-        return jsonify({"message": "Field forename is missing."}), 400
+def issued_before_deletion(claims):
+    # A refresh token outlives the account it was issued for; one from before the latest deletion
+    # of its subject must not mint tokens for an account registered again under that email.
+    deleted_at = database.session.query(
+        database.func.max(AccountDeletion.deleted_at)
+    ).filter(AccountDeletion.email == claims['sub']).scalar()
 
-    if 'surname' not in req_data or not req_data['surname']:
-        return jsonify({"message": "Field surname is missing."}), 400
+    return deleted_at is not None and claims.get('iat', 0) <= calendar.timegm(deleted_at.utctimetuple())
 
-    if 'email' not in req_data or not req_data['email']:
-        return jsonify({"message": "Field email is missing."}), 400
+def registration_error(data):
+    for field in ['forename', 'surname', 'email', 'password']:
+        if field not in data or not data[field]:
+            return "Field %s is missing." % field
 
-    if 'password' not in req_data or not req_data['password']:
-        return jsonify({"message": "Field password is missing."}), 400
+    if not re.match(email_pattern, data['email']):
+        return "Invalid email."
 
-    if not re.match(email_pattern, req_data['email']):
-        return jsonify({"message": "Invalid email."}), 400
+    if len(data['password']) < 8:
+        return "Invalid password."
+
+    return None
+
+@application.errorhandler(HashingQueueFull)
+def hashing_queue_full(error):
+    return jsonify({"message": "Service is busy, try again later."}), 503, {"Retry-After": "1"}
+
+@application.route('/register_customer', methods=['POST'])
+def register_customer():
+    req_data = request.get_json()
 
-    if len(req_data['password']) < 8:
-        return jsonify({"message": "Invalid password."}), 400
+    error = registration_error(req_data)
+    if error:
+        return jsonify({"message": error}), 400
 
-    existing = User.query.filter_by(email=req_data['email']).first()
+    existing = find_user(req_data['email'])
     if existing:
         return jsonify({"message": "Email already exists."}), 400
 
-    hashed_pw = sha256_crypt.hash(req_data['password'])
+    hashed_pw = hash_password(req_data['password'])
     new_user = User(
         forename=req_data['forename'],
         surname=req_data['surname'],
@@ -44,7 +73,13 @@ def register_customer():
     )
 
     database.session.add(new_user)
-    database.session.commit()
+    try:
+        database.session.commit()
+    except IntegrityError:
+        database.session.rollback()
+        return jsonify({"message": "Email already exists."}), 400
+    finally:
+        user_cache.invalidate(req_data['email'])
 
     return '', 200
 
@@ -52,29 +87,15 @@ def register_customer():
 def register_courier():
     req_data = request.get_json()
 
-    if 'forename' not in req_data or not req_data['forename']:
-        return jsonify({"message": "Field forename is missing."}), 400
-
-    if 'surname' not in req_data or not req_data['surname']:
-        return jsonify({"message": "Field surname is missing."}), 400
-
-    if 'email' not in req_data or not req_data['email']:
-        return jsonify({"message": "Field email is missing."}), 400
-
-    if 'password' not in req_data or not req_data['password']:
-        return jsonify({"message": "Field password is missing."}), 400
+    error = registration_error(req_data)
+    if error:
+        return jsonify({"message": error}), 400
 
-    if not re.match(email_pattern, req_data['email']):
-        return jsonify({"message": "Invalid email."}), 400
-
-    if len(req_data['password']) < 8:
-        return jsonify({"message": "Invalid password."}), 400
-
-    existing = User.query.filter_by(email=req_data['email']).first()
+    existing = find_user(req_data['email'])
     if existing:
         return jsonify({"message": "Email already exists."}), 400
 
-    hashed_pw = sha256_crypt.hash(req_data['password'])
+    hashed_pw = hash_password(req_data['password'])
     new_user = User(
         forename=req_data['forename'],
         surname=req_data['surname'],
@@ -84,10 +105,118 @@ def register_courier():
     )
 
     database.session.add(new_user)
-    database.session.commit()
+    try:
+        database.session.commit()
+    except IntegrityError:
+        database.session.rollback()
+        return jsonify({"message": "Email already exists."}), 400
+    finally:
+        user_cache.invalidate(req_data['email'])
 
     return '', 200
 
+@application.route('/register_bulk', methods=['POST'])
+@jwt_required()
+def register_bulk():
+    if 'owner' not in get_jwt().get('roles', []):
+        return jsonify({"msg": "Missing Authorization Header"}), 401
+
+    if 'file' in request.files:
+        try:
+            content = request.files['file'].stream.read().decode('utf-8')
+        except Exception:
+            return jsonify({"message": "Field file is missing."}), 400
+
+        rows = []
+        for row in csv.reader(io.StringIO(content)):
+            rows.append(dict(zip(['forename', 'surname', 'email', 'password', 'role'], [value.strip() for value in row])))
+    else:
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list):
+            return jsonify({"message": "Field users is missing."}), 400
+
+    results = [None] * len(rows)
+    pending = []
+    seen_emails = set()
+
+    for index, row in enumerate(rows):
+        # JSON rows may hold any type; nulls count as missing fields, other non-strings are invalid.
+        if not isinstance(row, dict) or any(
+            row.get(field) is not None and not isinstance(row[field], str)
+            for field in ['forename', 'surname', 'email', 'password', 'role']
+        ):
+            results[index] = {"row": index, "status": "error", "message": "Invalid row."}
+            continue
+
+        error = registration_error(row)
+        if not error and row.get('role') not in ('customer', 'courier'):
+            error = "Invalid role."
+        # The email column compares case-insensitively in MySQL.
+        if not error and row['email'].lower() in seen_emails:
+            error = "Email already exists."
+
+        if error:
+            results[index] = {"row": index, "status": "error", "message": error}
+            continue
+
+        seen_emails.add(row['email'].lower())
+        pending.append(index)
+
+    chunk_size = application.config['BULK_REGISTRATION_CHUNK_SIZE']
+
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+
+        existing = set(email.lower() for (email,) in database.session.query(User.email).filter(
+            User.email.in_([rows[index]['email'] for index in chunk])
+        ))
+
+        new_rows = []
+        for index in chunk:
+            if rows[index]['email'].lower() in existing:
+                results[index] = {"row": index, "status": "error", "message": "Email already exists."}
+            else:
+                new_rows.append(index)
+
+        if not new_rows:
+            continue
+
+        hashes = hash_passwords([rows[index]['password'] for index in new_rows])
+
+        users = [
+            {
+                "forename": rows[index]['forename'],
+                "surname": rows[index]['surname'],
+                "email": rows[index]['email'],
+                "password": hashed_pw,
+                "role": rows[index]['role']
+            }
+            for index, hashed_pw in zip(new_rows, hashes)
+        ]
+
+        try:
+            database.session.execute(insert(User), users)
+            database.session.commit()
+            created = new_rows
+        except IntegrityError:
+            # An email registered concurrently since the check: retry the chunk row by row.
+            database.session.rollback()
+            created = []
+            for index, user in zip(new_rows, users):
+                try:
+                    database.session.execute(insert(User), [user])
+                    database.session.commit()
+                    created.append(index)
+                except IntegrityError:
+                    database.session.rollback()
+                    results[index] = {"row": index, "status": "error", "message": "Email already exists."}
+
+        for index in created:
+            user_cache.invalidate(rows[index]['email'])
+            results[index] = {"row": index, "status": "created", "email": rows[index]['email']}
+
+    return jsonify({"results": results}), 200
+
 @application.route('/login', methods=['POST'])
 def login():
     json_data = request.get_json()
@@ -101,21 +230,53 @@ def login():
     if not re.match(email_pattern, json_data['email']):
         return jsonify({"message": "Invalid email."}), 400
 
-    user = User.query.filter_by(email=json_data['email']).first()
+    retry_after = login_retry_after(request.remote_addr, json_data['email'])
+    if retry_after:
+        return jsonify({"message": "Too many login attempts."}), 429, {"Retry-After": str(math.ceil(retry_after))}
 
-    if not user or not sha256_crypt.verify(json_data['password'], user.password):
+    user = find_user(json_data['email'])
+
+    if not user:
         return jsonify({"message": "Invalid credentials."}), 400
 
-    token_claims = {
-        "forename": user.forename,
-        "surname": user.surname,
-        "roles": [user.role],
-        "type": "access"
-    }
+    valid, new_hash = verify_and_update_password(json_data['password'], user.password)
+    if not valid:
+        return jsonify({"message": "Invalid credentials."}), 400
+
+    if new_hash:
+        User.query.filter_by(id=user.id).update({"password": new_hash})
+        database.session.commit()
+        user_cache.invalidate(user.email)
 
     access_token = create_access_token(
         identity=user.email,
-        additional_claims=token_claims
+        additional_claims=token_claims(user, "access")
+    )
+
+    refresh_token = create_refresh_token(
+        identity=user.email,
+        additional_claims=token_claims(user, "refresh")
+    )
+
+    return jsonify({"accessToken": access_token, "refreshToken": refresh_token}), 200
+
+@application.route('/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def refresh():
+    claims = get_jwt()
+    user_email = claims['sub']
+
+    if issued_before_deletion(claims):
+        return jsonify({"msg": "Token has been revoked"}), 401
+
+    user = find_user(user_email)
+
+    if not user:
+        return jsonify({"message": "Unknown user."}), 400
+
+    access_token = create_access_token(
+        identity=user_email,
+        additional_claims=token_claims(user, "access")
     )
 
     return jsonify({"accessToken": access_token}), 200
@@ -126,32 +287,74 @@ def delete_user():
     jwt_data = get_jwt()
     user_email = jwt_data['sub']
 
-    user = User.query.filter_by(email=user_email).first()
+    if issued_before_deletion(jwt_data):
+        return jsonify({"msg": "Token has been revoked"}), 401
 
-    if not user:
+    user_cache.invalidate(user_email)
+
+    # The revocation log may be in another database, and the two commits are not atomic. The
+    # revocation goes first: one left behind by a failed delete only rejects tokens issued before it.
+    revoked_at = datetime.utcnow()
+    database.session.add(TokenRevocation(subject=user_email, revoked_at=revoked_at))
+    database.session.commit()
+
+    deleted = User.query.filter_by(email=user_email).delete()
+
+    if not deleted:
+        database.session.rollback()
         return jsonify({"message": "Unknown user."}), 400
 
-    database.session.delete(user)
+    database.session.add(AccountDeletion(email=user_email, deleted_at=revoked_at))
     database.session.commit()
 
+    # A login running concurrently may have cached the user again before the commit.
+    user_cache.invalidate(user_email)
+
     return '', 200
 
+@application.route('/metrics', methods=['GET'])
+@jwt_required()
+def metrics():
+    if 'owner' not in get_jwt().get('roles', []):
+        return jsonify({"msg": "Missing Authorization Header"}), 401
+
+    return jsonify({
+        "login_throttling": {
+            "ip": ip_limiter.statistics(),
+            "email": email_limiter.statistics()
+        },
+        "user_cache": user_cache.statistics(),
+        "database_pool": pool_statistics(database.engines)
+    }), 200
+
+def init_database():
+    database.create_all(bind_key=None)
+
+    # A separate revocation database is reached through an INSERT-only account and gets its table
+    # from its own init script; without REVOCATION_DATABASE_URL the log lives in this database.
+    if application.config['SQLALCHEMY_BINDS']['revocations']['url'] == application.config['SQLALCHEMY_DATABASE_URI']:
+        database.create_all(bind_key='revocations')
+
+    owner = User.query.filter_by(email='onlymoney@gmail.com').first()
+
+    if not owner:
+        owner = User(
+            forename='Scrooge',
+            surname='McDuck',
+            email='onlymoney@gmail.com',
+            password=hash_password('evenmoremoney'),
+            role='owner'
+        )
+        database.session.add(owner)
+        database.session.commit()
+        print("[OK] Default owner kreiran: onlymoney@gmail.com")
+
+@application.cli.command('init-db')
+def init_db_command():
+    init_database()
+
 if __name__ == '__main__':
     with application.app_context():
-        database.create_all()
-
-        owner = User.query.filter_by(email='onlymoney@gmail.com').first()
-
-        if not owner:
-            owner = User(
-                forename='Scrooge',
-                surname='McDuck',
-                email='onlymoney@gmail.com',
-                password=sha256_crypt.hash('evenmoremoney'),
-                role='owner'
-            )
-            database.session.add(owner)
-            database.session.commit()
-            print("[OK] Default owner kreiran: onlymoney@gmail.com")
+        init_database()
 
     application.run(debug=True, host='0.0.0.0', port=5000)
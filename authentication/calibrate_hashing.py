@@ -0,0 +1,78 @@
+import argparse
+import time
+from configuration import application
+from hashing import build_context
+
+parser = argparse.ArgumentParser(
+    description="Measures password verification latency for a range of hash rounds on this host"
+)
+
+parser.add_argument(
+    "--scheme",
+    default=application.config['PASSWORD_SCHEME'],
+    help="passlib scheme to benchmark"
+)
+
+parser.add_argument(
+    "--rounds",
+    type=int,
+    nargs="+",
+    default=[5000, 50000, 100000, 250000, 535000, 1000000],
+    help="Round counts to measure"
+)
+
+parser.add_argument(
+    "--samples",
+    type=int,
+    default=50,
+    help="Verifications measured per round count"
+)
+
+parser.add_argument(
+    "--target-p99",
+    type=float,
+    default=None,
+    help="Target p99 verification latency in milliseconds"
+)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(scheme, rounds, samples):
+    context = build_context(scheme, rounds)
+    hashed = context.hash("calibration-password")
+
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        context.verify("calibration-password", hashed)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return timings
+
+
+if __name__ == '__main__':
+    arguments = parser.parse_args()
+
+    print("Current policy: %s, %d rounds" % (application.config['PASSWORD_SCHEME'], application.config['PASSWORD_ROUNDS']))
+    print("%10s %10s %10s %10s" % ("rounds", "mean ms", "p50 ms", "p99 ms"))
+
+    best = None
+    for rounds in arguments.rounds:
+        timings = measure(arguments.scheme, rounds, arguments.samples)
+        p99 = percentile(timings, 0.99)
+
+        print("%10d %10.2f %10.2f %10.2f" % (rounds, sum(timings) / len(timings), percentile(timings, 0.5), p99))
+
+        if arguments.target_p99 is not None and p99 <= arguments.target_p99:
+            best = rounds if best is None else max(best, rounds)
+
+    if arguments.target_p99 is not None:
+        if best is None:
+            print("No measured round count meets a p99 of %.2f ms." % arguments.target_p99)
+        else:
+            print("Suggested PASSWORD_ROUNDS=%d for a p99 of %.2f ms." % (best, arguments.target_p99))
@@ -0,0 +1,116 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from passlib.context import CryptContext
+from configuration import application
+
+
+class HashingQueueFull(Exception):
+    pass
+
+
+LEGACY_SCHEME = 'sha256_crypt'
+
+_context = None
+
+
+def build_context(scheme, rounds):
+    schemes = [scheme] if scheme == LEGACY_SCHEME else [scheme, LEGACY_SCHEME]
+
+    # min_rounds equal to the default makes needs_update() flag every hash below the policy.
+    return CryptContext(
+        schemes=schemes,
+        default=scheme,
+        deprecated='auto',
+        **{
+            '%s__default_rounds' % scheme: rounds,
+            '%s__min_rounds' % scheme: rounds
+        }
+    )
+
+
+def _init_worker(scheme, rounds):
+    global _context
+    _context = build_context(scheme, rounds)
+
+
+def _hash(secret):
+    return _context.hash(secret)
+
+
+def _verify_and_update(secret, hashed):
+    return _context.verify_and_update(secret, hashed)
+
+
+class HashingExecutor:
+
+    def __init__(self, workers, queue_size, scheme, rounds):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.scheme = scheme
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+    def _get_pool(self):
+        # Created lazily and per process, so forked server workers never share a pool.
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_worker,
+                    initargs=(self.scheme, self.rounds)
+                )
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingQueueFull()
+
+        try:
+            return self._get_pool().submit(function, *args).result()
+        except BrokenProcessPool:
+            with self._lock:
+                self._pool = None
+            raise
+        finally:
+            self._slots.release()
+
+    def map(self, function, values, chunksize=1):
+        # A batch takes a single queue slot and is spread over every pool process.
+        if not self._slots.acquire(blocking=False):
+            raise HashingQueueFull()
+
+        try:
+            return list(self._get_pool().map(function, values, chunksize=chunksize))
+        except BrokenProcessPool:
+            with self._lock:
+                self._pool = None
+            raise
+        finally:
+            self._slots.release()
+
+
+executor = HashingExecutor(
+    application.config['HASHING_WORKERS'],
+    application.config['HASHING_QUEUE_SIZE'],
+    application.config['PASSWORD_SCHEME'],
+    application.config['PASSWORD_ROUNDS']
+)
+
+
+def hash_password(secret):
+    return executor.run(_hash, secret)
+
+
+def hash_passwords(secrets):
+    chunksize = max(1, len(secrets) // (executor.workers * 4))
+    return executor.map(_hash, secrets, chunksize=chunksize)
+
+
+def verify_and_update_password(secret, hashed):
+    return executor.run(_verify_and_update, secret, hashed)
@@ -12,3 +12,27 @@ class User(database.Model):
 
     def __repr__(self):
         return '<User %s (%s)>' % (self.email, self.role)
+
+
+class AccountDeletion(database.Model):
+    # Local copy of the revocation log: the account that writes token_revocations may not read it.
+    __tablename__ = 'account_deletions'
+
+    id = database.Column(database.Integer, primary_key=True)
+    email = database.Column(database.String(256), nullable=False, index=True)
+    deleted_at = database.Column(database.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<AccountDeletion %s at %s>' % (self.email, self.deleted_at)
+
+
+class TokenRevocation(database.Model):
+    __bind_key__ = 'revocations'
+    __tablename__ = 'token_revocations'
+
+    id = database.Column(database.Integer, primary_key=True)
+    subject = database.Column(database.String(256), nullable=False, index=True)
+    revoked_at = database.Column(database.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<TokenRevocation %s at %s>' % (self.subject, self.revoked_at)
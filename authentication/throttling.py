@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+from configuration import application
+
+
+class TokenBucketLimiter:
+
+    def __init__(self, rate, burst, max_keys):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.allowed = 0
+        self.rejected = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        # Returns 0 when the request may proceed, otherwise the seconds until a token is available.
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self.allowed += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.rejected += 1
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+            return wait
+
+    def statistics(self):
+        with self._lock:
+            return {
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "tracked_keys": len(self._buckets)
+            }
+
+
+ip_limiter = TokenBucketLimiter(
+    application.config['LOGIN_RATE_PER_IP'],
+    application.config['LOGIN_BURST_PER_IP'],
+    application.config['LOGIN_LIMITER_MAX_KEYS']
+)
+
+email_limiter = TokenBucketLimiter(
+    application.config['LOGIN_RATE_PER_EMAIL'],
+    application.config['LOGIN_BURST_PER_EMAIL'],
+    application.config['LOGIN_LIMITER_MAX_KEYS']
+)
+
+
+def login_retry_after(ip, email):
+    wait = ip_limiter.acquire(ip)
+    if wait:
+        return wait
+
+    return email_limiter.acquire(email.lower())
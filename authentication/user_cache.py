@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from configuration import application
+from models import User
+
+CachedUser = namedtuple('CachedUser', ['id', 'forename', 'surname', 'email', 'password', 'role'])
+
+MISSING = object()
+
+
+class UserCache:
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email):
+        # MySQL compares users.email without regard to case, so every spelling shares one entry.
+        email = email.lower()
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[email]
+                self.misses += 1
+                return MISSING
+
+            self._entries.move_to_end(email)
+            if entry[1] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry[1]
+
+    def generation(self):
+        return self._generation
+
+    def put(self, email, user, generation=None):
+        ttl = self.ttl if user is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+
+        email = email.lower()
+        with self._lock:
+            # A record read before an invalidation may already be stale, so it is not cached.
+            if generation is not None and generation != self._generation:
+                return
+
+            self._entries[email] = (time.monotonic() + ttl, user)
+            self._entries.move_to_end(email)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, email):
+        with self._lock:
+            self._entries.pop(email.lower(), None)
+            self._generation += 1
+
+    def statistics(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries)
+            }
+
+
+user_cache = UserCache(
+    application.config['USER_CACHE_SIZE'],
+    application.config['USER_CACHE_TTL'],
+    application.config['USER_CACHE_NEGATIVE_TTL']
+)
+
+
+def find_user(email):
+    cached = user_cache.get(email)
+    if cached is not MISSING:
+        return cached
+
+    generation = user_cache.generation()
+    user = User.query.filter_by(email=email).first()
+    if user:
+        user = CachedUser(user.id, user.forename, user.surname, user.email, user.password, user.role)
+
+    user_cache.put(email, user, generation)
+    return user
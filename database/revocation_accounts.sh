@@ -0,0 +1,18 @@
+#!/bin/sh
+# Runs once, when revocationDB is initialised. revocationDB is the only container on both networks;
+# the authentication service may only append to the revocation log and the store services may
+# only read it. MySQL grants on a table only once it exists, so the table is created here with
+# the schema the models give it; create_all then leaves it alone.
+mysql -uroot -p"$MYSQL_ROOT_PASSWORD" "$MYSQL_DATABASE" <<SQL
+CREATE TABLE IF NOT EXISTS token_revocations (
+    id INTEGER NOT NULL AUTO_INCREMENT,
+    subject VARCHAR(256) NOT NULL,
+    revoked_at DATETIME NOT NULL,
+    PRIMARY KEY (id),
+    INDEX ix_token_revocations_subject (subject)
+);
+CREATE USER IF NOT EXISTS 'revocation_writer'@'%' IDENTIFIED BY '$REVOCATION_WRITER_PASSWORD';
+GRANT INSERT ON \`$MYSQL_DATABASE\`.token_revocations TO 'revocation_writer'@'%';
+CREATE USER IF NOT EXISTS 'revocation_reader'@'%' IDENTIFIED BY '$REVOCATION_READER_PASSWORD';
+GRANT SELECT ON \`$MYSQL_DATABASE\`.token_revocations TO 'revocation_reader'@'%';
+SQL